@@ -2,17 +2,66 @@
 Agent Core - Funzioni essenziali per Planet AI
 """
 
-from geopy.geocoders import Nominatim
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_utils import cache_get, cache_key, cache_set
+from config import CACHE_TTL_GEOCODING
 
 DEBUG_MODE = False
 
-# Geocoder
-_geolocator = Nominatim(user_agent="planet_ai_omi_agent")
+# Cache in memoria (per processo) davanti alla cache su disco:
+# chiave normalizzata -> (lat, lon, indirizzo trovato)
+_GEO_MEMO: dict[str, tuple[float, float, str]] = {}
+
+_SPAZI_RE = re.compile(r"\s+")
+
+# Geocoder (creato al primo utilizzo)
+_geocode = None
+
+# Nominatim: massimo 1 richiesta al secondo (policy di utilizzo)
+NOMINATIM_MIN_DELAY = 1.0
 
+# Thread per il geocoding di più indirizzi (le richieste restano rate-limited)
+GEOCODE_WORKERS = 4
 
-def geocode_indirizzo(comune: str, indirizzo: str) -> tuple[float, float, dict]:
+
+def get_geocode():
+    """
+    Restituisce la funzione di geocoding Nominatim, creandola al primo utilizzo:
+    geopy viene importato solo quando serve davvero geocodare.
+    
+    Il geocoder usa una sessione requests condivisa (connessioni riutilizzate)
+    ed è avvolto da un RateLimiter che rispetta il limite di 1 richiesta/secondo.
+    """
+    global _geocode
+    if _geocode is None:
+        from geopy.adapters import RequestsAdapter
+        from geopy.extra.rate_limiter import RateLimiter
+        from geopy.geocoders import Nominatim
+        geolocator = Nominatim(
+            user_agent="planet_ai_omi_agent",
+            adapter_factory=RequestsAdapter,
+        )
+        _geocode = RateLimiter(
+            geolocator.geocode,
+            min_delay_seconds=NOMINATIM_MIN_DELAY,
+            max_retries=2,
+            swallow_exceptions=False,
+        )
+    return _geocode
+
+
+def _normalizza(testo: str) -> str:
+    """Minuscolo, senza spazi ai bordi e con spazi interni compattati."""
+    return _SPAZI_RE.sub(" ", testo.strip().lower())
+
+
+def geocode_indirizzo(comune: str, indirizzo: str, timeout: int = 15) -> tuple[float, float, dict]:
     """
     Geocoda 'indirizzo, comune, Italia' usando Nominatim.
+    I risultati trovati vengono messi in cache in memoria e su disco
+    (CACHE_TTL_GEOCODING), con chiave normalizzata su (comune, indirizzo).
     
     Returns:
         tuple: (lat, lon, geo_info)
@@ -22,24 +71,83 @@ def geocode_indirizzo(comune: str, indirizzo: str) -> tuple[float, float, dict]:
     if DEBUG_MODE:
         print(f"[GEO] Geocoding: {full_address}")
 
+    key = cache_key(_normalizza(comune), _normalizza(indirizzo))
+    cached = _GEO_MEMO.get(key)
+    if cached is None:
+        cached = cache_get("geocoding", key, CACHE_TTL_GEOCODING)
+        if cached is not None:
+            _GEO_MEMO[key] = cached = tuple(cached)
+    if cached is not None:
+        lat, lon, address = cached
+        return (lat, lon, {
+            'success': True,
+            'message': f"✅ Trovato: {address}"
+        })
+
     try:
-        loc = _geolocator.geocode(full_address, timeout=15)
+        loc = get_geocode()(full_address, timeout=timeout)
         if loc is None:
-            print(f"[GEO][WARN] Geocoding fallito")
+            # Esito nel geo_info: per le liste il riepilogo lo stampa il chiamante
+            if DEBUG_MODE:
+                print(f"[GEO][WARN] Geocoding fallito: {full_address}")
             return (0, 0, {
                 'success': False,
                 'message': f"❌ Via non trovata: '{indirizzo}' a {comune}"
             })
         
         # TROVATO
+        _GEO_MEMO[key] = (loc.latitude, loc.longitude, loc.address)
+        cache_set("geocoding", key, [loc.latitude, loc.longitude, loc.address])
         return (loc.latitude, loc.longitude, {
             'success': True,
             'message': f"✅ Trovato: {loc.address}"
         })
         
     except Exception as e:
-        print(f"[GEO][ERROR] Geocoding errore: {e}")
+        if DEBUG_MODE:
+            print(f"[GEO][ERROR] Geocoding errore ({full_address}): {e}")
         return (0, 0, {
             'success': False,
             'message': f"❌ Errore connessione: riprova tra qualche secondo"
-        })
\ No newline at end of file
+        })
+
+
+def geocode_batch(comune: str, indirizzi: list[str], timeout: int = 15) -> list[tuple[float, float, dict]]:
+    """
+    Geocoda più indirizzi dello stesso comune in parallelo (GEOCODE_WORKERS thread).
+    Gli indirizzi ripetuti vengono geocodati una volta sola e quelli
+    già in cache rispondono subito senza attendere in coda;
+    le richieste reali passano dal RateLimiter condiviso (thread-safe),
+    quindi verso Nominatim resta il limite di 1 richiesta/secondo.
+    
+    Returns:
+        list: una tupla (lat, lon, geo_info) per ogni indirizzo, nello stesso ordine
+    """
+    # Indirizzi uguali (a meno di maiuscole/spazi) geocodati una volta sola:
+    # altrimenti più thread mancano la cache insieme e interrogano Nominatim
+    # ognuno per conto proprio per lo stesso indirizzo
+    unici = {}
+    for indirizzo in indirizzi:
+        unici.setdefault(_normalizza(indirizzo), indirizzo)
+    
+    if len(unici) <= 1:
+        risultati_unici = [geocode_indirizzo(comune, indirizzo, timeout) for indirizzo in unici.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=GEOCODE_WORKERS) as executor:
+            risultati_unici = list(executor.map(
+                lambda indirizzo: geocode_indirizzo(comune, indirizzo, timeout), unici.values()
+            ))
+    
+    # Di nuovo uno per indirizzo, nell'ordine originale (geo_info copiato per ognuno)
+    per_chiave = dict(zip(unici, risultati_unici))
+    risultati = []
+    for indirizzo in indirizzi:
+        lat, lon, geo_info = per_chiave[_normalizza(indirizzo)]
+        risultati.append((lat, lon, dict(geo_info)))
+    
+    # Un solo riepilogo per lista (i singoli fallimenti solo in DEBUG_MODE)
+    falliti = sum(1 for _, _, geo_info in risultati if not geo_info['success'])
+    if falliti:
+        print(f"[GEO][WARN] {falliti}/{len(indirizzi)} indirizzi non geocodati a {comune}")
+    
+    return risultati
@@ -0,0 +1,212 @@
+"""
+Cache Utils - Cache su disco con scadenza per Planet AI
+=======================================================
+Memorizza in un piccolo database SQLite i risultati delle chiamate di rete
+(Nominatim, Immobiliare.it, Claude) così che una seconda ricerca con gli
+stessi input non rifaccia la richiesta.
+
+I valori vengono salvati come JSON: devono quindi essere dict/list/str/numeri.
+Se è installato orjson (estensione C) viene usato al posto del modulo json.
+Ogni errore della cache viene solo loggato: la cache non deve mai bloccare
+il flusso principale.
+
+Le voci scadute vengono cancellate all'apertura del database e poi ogni
+_SCRITTURE_TRA_PULIZIE scritture (durate in config.CACHE_TTL_NAMESPACE),
+così il file non cresce senza limite. I gruppi in config.CACHE_MAX_VOCI
+tengono inoltre solo le voci più recenti.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from config import CACHE_DIR, CACHE_MAX_VOCI, CACHE_TTL_NAMESPACE, DEBUG_MODE
+
+
+# Serializzazione JSON: orjson se disponibile, altrimenti json standard
+try:
+    import orjson
+
+    def _dumps(value: Any) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def _dumps_chiave(parts: tuple) -> bytes:
+        return orjson.dumps(
+            parts,
+            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+            default=str,
+        )
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(value: Any) -> bytes:
+        return json.dumps(value).encode("utf-8")
+
+    def _dumps_chiave(parts: tuple) -> bytes:
+        return json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+
+    _loads = json.loads
+
+
+_DB_PATH = os.path.join(CACHE_DIR, "planetai_cache.sqlite")
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+# Pulizia delle voci scadute ogni N scritture (oltre a quella all'apertura)
+_SCRITTURE_TRA_PULIZIE = 100
+_scritture = 0
+
+
+def _limita_voci(conn: sqlite3.Connection, namespace: str, max_voci: int) -> int:
+    """
+    Tiene solo le max_voci voci più recenti del gruppo.
+    Da chiamare con _lock acquisito.
+
+    Returns:
+        int: voci cancellate
+    """
+    return conn.execute(
+        "DELETE FROM cache WHERE namespace = ? AND key NOT IN ("
+        " SELECT key FROM cache WHERE namespace = ? ORDER BY ts DESC LIMIT ?)",
+        (namespace, namespace, max_voci),
+    ).rowcount
+
+
+def _pulisci_scaduti(conn: sqlite3.Connection) -> None:
+    """
+    Cancella le voci più vecchie della durata del loro gruppo.
+    Da chiamare con _lock acquisito (o durante l'apertura della connessione).
+    """
+    adesso = time.time()
+    ttl_massimo = max(CACHE_TTL_NAMESPACE.values())
+    
+    cancellate = 0
+    for namespace, ttl in CACHE_TTL_NAMESPACE.items():
+        cancellate += conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND ts < ?",
+            (namespace, adesso - ttl),
+        ).rowcount
+    
+    # Gruppi senza durata configurata: durata più lunga
+    segnaposti = ",".join("?" * len(CACHE_TTL_NAMESPACE))
+    cancellate += conn.execute(
+        f"DELETE FROM cache WHERE namespace NOT IN ({segnaposti}) AND ts < ?",
+        (*CACHE_TTL_NAMESPACE, adesso - ttl_massimo),
+    ).rowcount
+    
+    for namespace, max_voci in CACHE_MAX_VOCI.items():
+        cancellate += _limita_voci(conn, namespace, max_voci)
+    
+    conn.commit()
+    
+    if DEBUG_MODE and cancellate:
+        print(f"[CACHE] Cancellate {cancellate} voci scadute")
+
+
+def _get_conn() -> sqlite3.Connection:
+    """Apre (una sola volta) la connessione al database della cache."""
+    global _conn
+
+    if _conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Streamlit esegue ogni sessione in un thread diverso: accesso serializzato da _lock
+        _conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " ts REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        _conn.commit()
+        _pulisci_scaduti(_conn)
+
+    return _conn
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Costruisce una chiave stabile (hash) a partire da valori qualsiasi.
+    Usa BLAKE2b a 128 bit: più veloce di SHA-256 e più che sufficiente
+    per distinguere le chiavi della cache.
+
+    Returns:
+        str: digest esadecimale (32 caratteri)
+    """
+    return hashlib.blake2b(_dumps_chiave(parts), digest_size=16).hexdigest()
+
+
+def cache_get(namespace: str, key: str, ttl: float) -> Optional[Any]:
+    """
+    Legge un valore dalla cache.
+
+    Args:
+        namespace: Gruppo logico (es. "geocoding")
+        key: Chiave del valore
+        ttl: Età massima in secondi
+
+    Returns:
+        Il valore salvato, o None se assente/scaduto
+    """
+    try:
+        with _lock:
+            row = _get_conn().execute(
+                "SELECT value, ts FROM cache WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        if row is None:
+            return None
+
+        value, ts = row
+        if time.time() - ts > ttl:
+            return None
+
+        # Voce corrotta o non decodificabile: trattata come assente
+        valore = _loads(value)
+    except (sqlite3.Error, OSError, ValueError, TypeError) as e:
+        print(f"[CACHE][WARN] Lettura fallita ({namespace}): {e}")
+        return None
+
+    if DEBUG_MODE:
+        print(f"[CACHE] Hit {namespace}:{key[:12]}")
+
+    return valore
+
+
+def cache_set(namespace: str, key: str, value: Any) -> None:
+    """
+    Salva un valore in cache (sovrascrive l'eventuale valore precedente).
+
+    Args:
+        namespace: Gruppo logico (es. "geocoding")
+        key: Chiave del valore
+        value: Valore serializzabile in JSON
+    """
+    global _scritture
+
+    try:
+        payload = _dumps(value)
+        with _lock:
+            conn = _get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, ts) VALUES (?, ?, ?, ?)",
+                (namespace, key, payload, time.time()),
+            )
+
+            # Gruppi voluminosi: limite applicato subito, non alla prossima pulizia
+            if namespace in CACHE_MAX_VOCI:
+                _limita_voci(conn, namespace, CACHE_MAX_VOCI[namespace])
+
+            conn.commit()
+
+            _scritture += 1
+            if _scritture % _SCRITTURE_TRA_PULIZIE == 0:
+                _pulisci_scaduti(conn)
+    except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+        print(f"[CACHE][WARN] Scrittura fallita ({namespace}): {e}")
@@ -5,10 +5,180 @@ Utilizza l'API Anthropic Claude per generare analisi approfondite
 confrontando dati OMI e mercato Immobiliare.it
 """
 
+import asyncio
+import importlib.util
 import os
-import json
-from typing import Dict, Optional, List
-import anthropic
+import re
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, Optional, List, Tuple
+
+from cache_utils import cache_get, cache_key, cache_set
+from config import CACHE_TTL_ANALISI_AI
+
+DEBUG_MODE = False
+
+# L'SDK anthropic viene importato solo al primo uso (import lento): qui si
+# verifica soltanto che sia installato, così l'app può disattivare l'analisi AI
+ANTHROPIC_AVAILABLE = importlib.util.find_spec("anthropic") is not None
+
+
+# Parametri chiamata Claude
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+CLAUDE_MAX_TOKENS = 4000
+# Budget ridotti quando i dati sono pochi (vedi _budget_token)
+CLAUDE_MAX_TOKENS_SENZA_DATI = 1500   # manca OMI o mercato
+CLAUDE_MAX_TOKENS_SENZA_AGENZIE = 3000
+CLAUDE_TEMPERATURE = 0.7
+CLAUDE_TIMEOUT = 60.0  # secondi
+CLAUDE_MAX_RETRIES = 2
+
+# Livelli di analisi: livello -> (modello, max_tokens massimo, temperatura).
+# "rapida" usa un modello più veloce ed economico con risposte brevi,
+# adatto a scorrere molte zone; "completa" è l'analisi standard.
+CLAUDE_MODEL_RAPIDO = "claude-haiku-4-5-20251001"
+LIVELLI_ANALISI = {
+    "completa": (CLAUDE_MODEL, CLAUDE_MAX_TOKENS, CLAUDE_TEMPERATURE),
+    "rapida": (CLAUDE_MODEL_RAPIDO, 1500, 0.3),
+}
+
+# Analisi in parallelo (analizza_molti): richieste contemporanee massime
+ANALISI_CONCORRENTI_MAX = 8
+
+# Estrazione raccomandazioni dalla risposta (pattern compilati una sola volta)
+# (solo la parola: la fine della riga si trova con str.find, senza il
+# backtracking di un pattern ^.*...*$ su ogni riga)
+_RACC_HEADER_RE = re.compile(r"raccomandazioni", re.IGNORECASE)
+_TITOLO_SEZIONE_RE = re.compile(r"^[ \t]*#", re.MULTILINE)
+_PUNTO_ELENCO_RE = re.compile(r"^[ \t]*(?:[-*•]|\d+[.)])[ \t]+(.+?)[ \t]*$", re.MULTILINE)
+
+# Ruolo e compito (testo statico)
+_PROMPT_RUOLO = """Sei un esperto analista immobiliare italiano con grande esperienza nel mercato residenziale.
+
+Devi analizzare i dati di una zona immobiliare e fornire un'analisi chiara e professionale.
+
+"""
+
+# Località analizzata: unico segnaposto comune/via, riempito con str.format
+_PROMPT_LOCALITA = """**LOCALITÀ ANALIZZATA:**
+- Comune: {comune}
+- Via/Zona: {via}
+
+---
+
+**DATI OMI (Osservatorio Mercato Immobiliare - Agenzia delle Entrate):**
+*(Valori reali da rogiti registrati)*
+"""
+
+# Sezioni del prompt con segnaposto (template definiti una sola volta)
+_PROMPT_OMI = """
+- Zona OMI: {zona_codice} - {zona_descrizione}
+- Valori €/m² (rogiti):
+  * Minimo: €{val_min_mq:,.0f}
+  * Mediano: €{val_med_mq:,.0f}
+  * Massimo: €{val_max_mq:,.0f}
+"""
+
+_PROMPT_PREZZI_TOTALI = """
+**Prezzi totali:**
+- Minimo: €{min:,.0f}
+- Mediano: €{mediano:,.0f}
+- Massimo: €{max:,.0f}
+"""
+
+_PROMPT_SUPERFICI = """
+**Superfici (m²):**
+- Minima: {min} m²
+- Mediana: {mediano} m²
+- Massima: {max} m²
+"""
+
+_PROMPT_PREZZI_MQ = """
+**Prezzi al m²:**
+- Minimo: €{min:,.0f}/m²
+- Mediano: €{mediano:,.0f}/m²
+- Massimo: €{max:,.0f}/m²
+"""
+
+_PROMPT_GAP = """
+---
+
+**GAP ANALYSIS:**
+- OMI Mediano: €{omi_mediano:,.0f}/m²
+- Mercato Mediano: €{mercato_mediano:,.0f}/m²
+- Gap Assoluto: €{gap_assoluto:,.0f}/m²
+- Gap Percentuale: {gap_percentuale:+.1f}%
+"""
+
+# Istruzioni finali del prompt: testo statico, costruito una sola volta
+_PROMPT_RICHIESTA = """
+
+---
+
+**ANALISI RICHIESTA:**
+
+Fornisci un'analisi professionale in italiano, strutturata in questo modo:
+
+## 1. SINTESI
+Panoramica generale della zona e del mercato (2-3 paragrafi)
+- Cosa emerge dai dati
+- Principale differenza tra valori OMI e prezzi di mercato
+
+## 2. CONFRONTO OMI vs MERCATO
+- Quanto è il gap percentuale tra OMI e mercato?
+- Cosa significa questo gap? (prezzi alti, allineati, o bassi?)
+- Perché c'è questa differenza?
+
+## 3. ANALISI OFFERTA IMMOBILIARE.IT
+- Quanti appartamenti ci sono in vendita
+- Fascia di prezzo (entry level, medio, alto di gamma)
+- Come sono distribuiti i prezzi
+- Quali agenzie operano nella zona
+
+## 4. ANALISI DEVELOPER/INVESTITORI
+Usa le metriche Developer fornite per analizzare:
+- **Saturazione mercato**: Quanto è competitivo? (Libero/Medio/Saturo)
+- **Concentrazione agenzie**: Il mercato è frammentato o concentrato?
+- **Pricing strategy**: I prezzi attuali sono sostenibili? Gap OMI giustificato?
+- **Opportunità per developer**: È un buon momento per entrare nel mercato?
+
+## 5. VALUTAZIONE DELLA ZONA
+- Come si posiziona questa zona rispetto ai valori OMI
+- È una zona economica, media o di prestigio?
+- Cosa giustifica i prezzi attuali
+
+## 6. CONSIGLI PRATICI
+
+**Per chi vuole comprare:**
+- Conviene comprare ora o aspettare?
+- I prezzi sono giusti o troppo alti?
+- Su cosa fare attenzione
+
+**Per chi vuole vendere:**
+- I prezzi richiesti sono realistici?
+- C'è margine per alzare/abbassare?
+- Come è la concorrenza
+
+**STILE:**
+- Scrivi in italiano semplice ma professionale
+- Usa i numeri concreti dall'analisi
+- Spiega i concetti tecnici in modo chiaro
+- Evita termini inglesi dove possibile
+- Dai consigli pratici e diretti
+- Non usare emoji
+
+**IMPORTANTE:** 
+Se alcuni dati mancano, dillo chiaramente e lavora con quello che hai.
+"""
+
+# Istruzioni statiche inviate prima dei dati, marcate per il prompt caching di
+# Anthropic: identiche a ogni chiamata, vengono rielaborate solo la prima volta
+_PROMPT_ISTRUZIONI = _PROMPT_RUOLO + _PROMPT_RICHIESTA.lstrip()
+
+
+# API key già trovata (la ricerca si fa una sola volta per processo)
+_API_KEY: Optional[str] = None
 
 
 def get_api_key() -> Optional[str]:
@@ -20,21 +190,37 @@ def get_api_key() -> Optional[str]:
     2. Streamlit secrets (se disponibile)
     3. File .env (se disponibile)
     
+    La chiave trovata viene memorizzata; se non viene trovata la ricerca
+    viene ripetuta alla chiamata successiva.
+    
     Returns:
         str: API key se trovata, None altrimenti
     """
+    global _API_KEY
+    if _API_KEY is None:
+        _API_KEY = _cerca_api_key()
+    return _API_KEY
+
+
+def _cerca_api_key() -> Optional[str]:
+    """
+    Ricerca effettiva della API key (vedi get_api_key).
+    """
     # 1. Variabile d'ambiente
     api_key = os.getenv('ANTHROPIC_API_KEY')
     if api_key:
         return api_key
     
-    # 2. Streamlit secrets
-    try:
-        import streamlit as st
-        if 'ANTHROPIC_API_KEY' in st.secrets:
-            return st.secrets['ANTHROPIC_API_KEY']
-    except:
-        pass
+    # 2. Streamlit secrets (solo se l'app gira già sotto Streamlit: da riga di
+    #    comando non serve importarlo)
+    if 'streamlit' in sys.modules:
+        try:
+            import streamlit as st
+            if 'ANTHROPIC_API_KEY' in st.secrets:
+                return st.secrets['ANTHROPIC_API_KEY']
+        except Exception:
+            # secrets.toml assente o non valido: si passa al file .env
+            pass
     
     # 3. File .env
     try:
@@ -43,12 +229,109 @@ def get_api_key() -> Optional[str]:
         api_key = os.getenv('ANTHROPIC_API_KEY')
         if api_key:
             return api_key
-    except:
+    except (ImportError, OSError):
+        # python-dotenv non installato o .env non leggibile
         pass
     
     return None
 
 
+@lru_cache(maxsize=4)
+def _get_client(api_key: str):
+    """
+    Client Anthropic sincrono, creato una volta per API key e poi riutilizzato:
+    le chiamate successive riusano le connessioni HTTP già aperte.
+    """
+    import anthropic
+    return anthropic.Anthropic(
+        api_key=api_key,
+        timeout=CLAUDE_TIMEOUT,
+        max_retries=CLAUDE_MAX_RETRIES,
+    )
+
+
+@lru_cache(maxsize=256)
+def _calcola_gap(omi_mediano: float, mercato_mediano: float) -> tuple:
+    """
+    Gap assoluto e percentuale tra mediano di mercato e mediano OMI.
+    Memorizzato: con Streamlit le stesse coppie si ripresentano a ogni rerun.
+    """
+    gap_assoluto = mercato_mediano - omi_mediano
+    gap_percentuale = (gap_assoluto / omi_mediano) * 100 if omi_mediano > 0 else 0
+    return gap_assoluto, gap_percentuale
+
+
+def _nuovo_client_async(api_key: str):
+    """
+    Nuovo client Anthropic asincrono (non memorizzato: è legato all'event loop
+    in cui viene usato la prima volta).
+    """
+    import anthropic
+    return anthropic.AsyncAnthropic(
+        api_key=api_key,
+        timeout=CLAUDE_TIMEOUT,
+        max_retries=CLAUDE_MAX_RETRIES,
+    )
+
+
+@dataclass(slots=True)
+class NormStats:
+    """
+    Statistiche di mercato lette e validate una sola volta per analisi.
+    Le terne (min, mediano, max) usano 0 per i valori assenti, come il prompt;
+    None indica che il blocco manca del tutto.
+    """
+    n_app: int
+    prezzo_totale: Optional[Tuple[float, float, float]]
+    superficie: Optional[Tuple[float, float, float]]
+    prezzo_mq: Optional[Tuple[float, float, float]]
+    mq_mediano: Optional[float]  # mediano €/m² grezzo, per il gap
+    agenzie: Optional[List[Tuple[str, int]]]  # top 5 (None se assenti)
+    top3_share: Optional[float]
+
+
+def _terna(valori: Optional[Dict]) -> Optional[Tuple[float, float, float]]:
+    """(min, mediano, max) di un blocco di statistiche, o None se assente."""
+    if not valori:
+        return None
+    return valori.get('min', 0), valori.get('mediano', 0), valori.get('max', 0)
+
+
+def _formatta_terna(template: str, terna: Tuple[float, float, float]) -> str:
+    """Riempie un template {min}/{mediano}/{max} con una terna di NormStats."""
+    minimo, mediano, massimo = terna
+    return template.format(min=minimo, mediano=mediano, max=massimo)
+
+
+def _normalizza_stats(stats_immobiliare: Optional[Dict]) -> Optional[NormStats]:
+    """
+    Converte il dict di calcola_statistiche in NormStats (None se assente).
+    """
+    if not stats_immobiliare:
+        return None
+    
+    prezzo_mq = stats_immobiliare.get('prezzo_mq')
+    
+    agenzie = None
+    if stats_immobiliare.get('agenzie'):
+        agenzie = []
+        if isinstance(stats_immobiliare['agenzie'], list):
+            agenzie = [
+                (a.get('agenzia', 'N/D'), a.get('count', 0))
+                for a in stats_immobiliare['agenzie'][:5]
+            ]
+    
+    return NormStats(
+        n_app=stats_immobiliare.get('n_appartamenti', 0),
+        prezzo_totale=_terna(stats_immobiliare.get('prezzo_totale')),
+        superficie=_terna(stats_immobiliare.get('superficie')),
+        prezzo_mq=_terna(prezzo_mq),
+        mq_mediano=prezzo_mq.get('mediano') if prezzo_mq else None,
+        agenzie=agenzie,
+        top3_share=stats_immobiliare.get('top3_share'),
+    )
+
+
 def calcola_gap_analysis(zona_omi: Dict, stats_immobiliare: Dict) -> Optional[Dict]:
     """
     Calcola il gap tra valori OMI e mercato.
@@ -60,21 +343,23 @@ def calcola_gap_analysis(zona_omi: Dict, stats_immobiliare: Dict) -> Optional[Di
     Returns:
         Dict con gap analysis o None se dati insufficienti
     """
-    if not zona_omi or not stats_immobiliare:
-        return None
-    
-    if zona_omi.get('val_med_mq') is None:
+    return _gap_analysis(zona_omi, _normalizza_stats(stats_immobiliare))
+
+
+def _gap_analysis(zona_omi: Optional[Dict], ns: Optional[NormStats]) -> Optional[Dict]:
+    """Come calcola_gap_analysis, con le statistiche già normalizzate."""
+    if not zona_omi or ns is None:
         return None
     
-    if not stats_immobiliare.get('prezzo_mq') or stats_immobiliare['prezzo_mq'].get('mediano') is None:
+    if zona_omi.get('val_med_mq') is None or ns.mq_mediano is None:
         return None
     
     omi_mediano = zona_omi['val_med_mq']
-    mercato_mediano = stats_immobiliare['prezzo_mq']['mediano']
+    mercato_mediano = ns.mq_mediano
     
-    gap_assoluto = mercato_mediano - omi_mediano
-    gap_percentuale = (gap_assoluto / omi_mediano) * 100 if omi_mediano > 0 else 0
+    gap_assoluto, gap_percentuale = _calcola_gap(omi_mediano, mercato_mediano)
     
+    # Dict nuovo a ogni chiamata: il chiamante può modificarlo senza toccare la cache
     return {
         'omi_mediano': omi_mediano,
         'mercato_mediano': mercato_mediano,
@@ -83,12 +368,236 @@ def calcola_gap_analysis(zona_omi: Dict, stats_immobiliare: Dict) -> Optional[Di
     }
 
 
+def _calcola_metriche(zona_omi: Optional[Dict], stats_immobiliare: Optional[Dict]) -> Dict:
+    """
+    Calcola una sola volta le metriche derivate usate dal prompt.
+    
+    Returns:
+        Dict con:
+        - 'stats': statistiche normalizzate (NormStats o None)
+        - 'gap': gap analysis (o None)
+        - 'saturazione': fascia di saturazione del mercato (o None senza dati)
+        - 'top3_share': quota % delle prime 3 agenzie (o None se non disponibile)
+        - 'concentrazione': fascia di concentrazione (o None se non disponibile)
+    """
+    ns = _normalizza_stats(stats_immobiliare)
+    metriche = {
+        'stats': ns,
+        'gap': _gap_analysis(zona_omi, ns),
+        'saturazione': None,
+        'top3_share': None,
+        'concentrazione': None,
+    }
+    
+    if ns is None or ns.n_app <= 0:
+        return metriche
+    
+    n_app = ns.n_app
+    
+    # Saturazione mercato
+    if n_app < 10:
+        metriche['saturazione'] = "LIBERO (poca concorrenza)"
+    elif n_app < 30:
+        metriche['saturazione'] = "MEDIO (concorrenza normale)"
+    else:
+        metriche['saturazione'] = "SATURO (alta concorrenza)"
+    
+    # Concentrazione agenzie (quota top 3 già calcolata da calcola_statistiche)
+    top3_share = ns.top3_share
+    if top3_share is not None:
+        if top3_share > 60:
+            concentrazione = "ALTA (pochi operatori dominanti)"
+        elif top3_share > 40:
+            concentrazione = "MEDIA (mix operatori)"
+        else:
+            concentrazione = "BASSA (mercato frammentato)"
+        
+        metriche['top3_share'] = top3_share
+        metriche['concentrazione'] = concentrazione
+    
+    return metriche
+
+
+def _budget_token(zona_omi: Optional[Dict], metriche: Dict) -> int:
+    """
+    max_tokens proporzionato ai dati disponibili: con dati parziali l'analisi
+    è necessariamente più breve e non serve lasciare spazio a 4000 token.
+    """
+    ns = metriche['stats']
+    if not zona_omi or ns is None or ns.n_app <= 0:
+        return CLAUDE_MAX_TOKENS_SENZA_DATI
+    if not ns.agenzie:
+        return CLAUDE_MAX_TOKENS_SENZA_AGENZIE
+    return CLAUDE_MAX_TOKENS
+
+
+# Testi fissi delle sezioni assenti / intestazioni
+_PROMPT_OMI_ASSENTE = "\n- Dati OMI non disponibili per questa zona\n"
+_PROMPT_MERCATO_TITOLO = "\n---\n\n**DATI MERCATO (Immobiliare.it - Nuove Costruzioni):**\n"
+_PROMPT_MERCATO_ASSENTE = "\n- Nessun dato disponibile dal mercato Immobiliare.it\n"
+
+
+def _sezione_mercato(ns: NormStats, metriche: Dict) -> str:
+    """
+    Dati di mercato e metriche developer di una zona (ns con almeno un appartamento).
+    """
+    parts = [f"""
+- Numero appartamenti in vendita (nuove costruzioni): {ns.n_app}
+"""]
+    
+    # Prezzi totali (se disponibili)
+    if ns.prezzo_totale:
+        parts.append(_formatta_terna(_PROMPT_PREZZI_TOTALI, ns.prezzo_totale))
+    
+    # Superfici (se disponibili)
+    if ns.superficie:
+        parts.append(_formatta_terna(_PROMPT_SUPERFICI, ns.superficie))
+    
+    # Prezzi al m² (se disponibili)
+    if ns.prezzo_mq:
+        parts.append(_formatta_terna(_PROMPT_PREZZI_MQ, ns.prezzo_mq))
+    
+    # Agenzie immobiliari (top 5, se disponibili)
+    if ns.agenzie is not None:
+        parts.append("\n**Agenzie immobiliari:**\n")
+        for nome_agenzia, count_agenzia in ns.agenzie:
+            parts.append(f"- {nome_agenzia}: {count_agenzia} appartamenti\n")
+    
+    # METRICHE DEVELOPER
+    parts.append("\n---\n\n**METRICHE DEVELOPER:**\n")
+    
+    parts.append(f"""
+- Saturazione mercato: {metriche['saturazione']}
+- Totale appartamenti in vendita: {ns.n_app}
+""")
+    
+    # Concentrazione agenzie (se disponibile)
+    if metriche['top3_share'] is not None:
+        parts.append(f"- Concentrazione Top 3 agenzie: {metriche['top3_share']:.1f}% - {metriche['concentrazione']}\n")
+    
+    return "".join(parts)
+
+
+# Costruttori specializzati dei dati di zona, uno per combinazione di dati
+# presenti (OMI, mercato, gap): ciascuno concatena solo le sezioni che servono.
+
+def _dati_completi(comune, via, zona_omi, gap_analysis, metriche) -> str:
+    return "".join([
+        _PROMPT_LOCALITA.format(comune=comune, via=via),
+        _PROMPT_OMI.format_map(zona_omi),
+        _PROMPT_MERCATO_TITOLO,
+        _sezione_mercato(metriche['stats'], metriche),
+        _PROMPT_GAP.format_map(gap_analysis),
+    ])
+
+
+def _dati_solo_omi(comune, via, zona_omi, gap_analysis, metriche) -> str:
+    return "".join([
+        _PROMPT_LOCALITA.format(comune=comune, via=via),
+        _PROMPT_OMI.format_map(zona_omi),
+        _PROMPT_MERCATO_TITOLO,
+        _PROMPT_MERCATO_ASSENTE,
+    ])
+
+
+def _dati_solo_mercato(comune, via, zona_omi, gap_analysis, metriche) -> str:
+    return "".join([
+        _PROMPT_LOCALITA.format(comune=comune, via=via),
+        _PROMPT_OMI_ASSENTE,
+        _PROMPT_MERCATO_TITOLO,
+        _sezione_mercato(metriche['stats'], metriche),
+    ])
+
+
+def _dati_vuoti(comune, via, zona_omi, gap_analysis, metriche) -> str:
+    return "".join([
+        _PROMPT_LOCALITA.format(comune=comune, via=via),
+        _PROMPT_OMI_ASSENTE,
+        _PROMPT_MERCATO_TITOLO,
+        _PROMPT_MERCATO_ASSENTE,
+    ])
+
+
+def _dati_generici(comune, via, zona_omi, gap_analysis, metriche) -> str:
+    """
+    Combinazioni rare (es. OMI e mercato senza prezzo al m², quindi senza gap):
+    stesse sezioni, scelte una per una.
+    """
+    ns = metriche['stats']
+    parts = [
+        _PROMPT_LOCALITA.format(comune=comune, via=via),
+        _PROMPT_OMI.format_map(zona_omi) if zona_omi and zona_omi.get('val_med_mq') else _PROMPT_OMI_ASSENTE,
+        _PROMPT_MERCATO_TITOLO,
+        _sezione_mercato(ns, metriche) if ns is not None and ns.n_app > 0 else _PROMPT_MERCATO_ASSENTE,
+    ]
+    if gap_analysis:
+        parts.append(_PROMPT_GAP.format_map(gap_analysis))
+    return "".join(parts)
+
+
+# (OMI presente, mercato presente, gap presente) -> costruttore
+_BUILDERS = {
+    (True, True, True): _dati_completi,
+    (True, False, False): _dati_solo_omi,
+    (False, True, False): _dati_solo_mercato,
+    (False, False, False): _dati_vuoti,
+}
+
+
+def prepara_dati_zona(
+    comune: str,
+    via: str,
+    zona_omi: Optional[Dict],
+    stats_immobiliare: Optional[Dict],
+    gap_analysis: Optional[Dict],
+    metriche: Dict
+) -> str:
+    """
+    Parte variabile del prompt: solo località e numeri della zona
+    (senza ruolo né istruzioni, che stanno in _PROMPT_ISTRUZIONI).
+    Le statistiche di mercato sono lette da metriche['stats'] (NormStats).
+    """
+    ns = metriche['stats']
+    chiave = (
+        bool(zona_omi and zona_omi.get('val_med_mq')),
+        ns is not None and ns.n_app > 0,
+        bool(gap_analysis),
+    )
+    builder = _BUILDERS.get(chiave, _dati_generici)
+    return builder(comune, via, zona_omi, gap_analysis, metriche)
+
+
+def _messaggi_analisi(istruzioni: str, dati: str) -> List[Dict]:
+    """
+    Messaggio utente in due blocchi: prima le istruzioni statiche, marcate con
+    cache_control (prefisso identico tra le chiamate, riusato da Anthropic per
+    alcuni minuti), poi i dati della zona.
+    """
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": istruzioni,
+                    "cache_control": {"type": "ephemeral"}
+                },
+                {
+                    "type": "text",
+                    "text": dati
+                }
+            ]
+        }
+    ]
+
+
 def prepara_prompt_analisi(
     comune: str,
     via: str,
     zona_omi: Optional[Dict],
     stats_immobiliare: Optional[Dict],
-    gap_analysis: Optional[Dict]
+    gap_analysis: Optional[Dict],
+    metriche: Optional[Dict] = None
 ) -> str:
     """
     Prepara il prompt per Claude con tutti i dati.
@@ -99,208 +608,234 @@ def prepara_prompt_analisi(
         zona_omi: Dati OMI
         stats_immobiliare: Statistiche mercato
         gap_analysis: Analisi gap
+        metriche: Metriche derivate già calcolate (da _calcola_metriche);
+                  se assenti vengono calcolate qui
     
     Returns:
         str: Prompt formattato
     """
-    prompt = f"""Sei un esperto analista immobiliare italiano con grande esperienza nel mercato residenziale.
+    if metriche is None:
+        metriche = _calcola_metriche(zona_omi, stats_immobiliare)
+    
+    dati = prepara_dati_zona(comune, via, zona_omi, stats_immobiliare, gap_analysis, metriche)
+    
+    return "".join([_PROMPT_RUOLO, dati, _PROMPT_RICHIESTA])
 
-Devi analizzare i dati di una zona immobiliare e fornire un'analisi chiara e professionale.
 
-**LOCALITÀ ANALIZZATA:**
-- Comune: {comune}
-- Via/Zona: {via}
+def _prepara_zona(
+    comune: str,
+    via: str,
+    zona_omi: Optional[Dict],
+    stats_immobiliare: Optional[Dict],
+    livello: str = "completa"
+) -> Tuple[Dict, str, str]:
+    """
+    Metriche, dati del prompt e chiave cache di una zona.
+    Stesso prompt (stessi dati) e stesso livello => stessa chiave.
+    """
+    metriche = _calcola_metriche(zona_omi, stats_immobiliare)
+    dati_zona = prepara_dati_zona(
+        comune, via, zona_omi, stats_immobiliare, metriche['gap'], metriche
+    )
+    return metriche, dati_zona, cache_key(_PROMPT_ISTRUZIONI, dati_zona, livello)
 
----
 
-**DATI OMI (Osservatorio Mercato Immobiliare - Agenzia delle Entrate):**
-*(Valori reali da rogiti registrati)*
-"""
-    
-    if zona_omi and zona_omi.get('val_med_mq'):
-        prompt += f"""
-- Zona OMI: {zona_omi['zona_codice']} - {zona_omi['zona_descrizione']}
-- Valori €/m² (rogiti):
-  * Minimo: €{zona_omi['val_min_mq']:,.0f}
-  * Mediano: €{zona_omi['val_med_mq']:,.0f}
-  * Massimo: €{zona_omi['val_max_mq']:,.0f}
-"""
-    else:
-        prompt += "\n- Dati OMI non disponibili per questa zona\n"
-    
-    prompt += "\n---\n\n**DATI MERCATO (Immobiliare.it - Nuove Costruzioni):**\n"
+def _verifica_input(
+    api_key: Optional[str],
+    zona_omi: Optional[Dict],
+    stats_immobiliare: Optional[Dict]
+) -> Optional[Dict]:
+    """
+    Controlli preliminari comuni a tutte le varianti di analisi.
     
-    if stats_immobiliare and stats_immobiliare.get('n_appartamenti', 0) > 0:
-        prompt += f"""
-- Numero appartamenti in vendita (nuove costruzioni): {stats_immobiliare.get('n_appartamenti', 'N/D')}
-"""
-        
-        # Prezzi totali (se disponibili)
-        if stats_immobiliare.get('prezzo_totale'):
-            prezzo_tot = stats_immobiliare['prezzo_totale']
-            prompt += f"""
-**Prezzi totali:**
-- Minimo: €{prezzo_tot.get('min', 0):,.0f}
-- Mediano: €{prezzo_tot.get('mediano', 0):,.0f}
-- Massimo: €{prezzo_tot.get('max', 0):,.0f}
-"""
-        
-        # Superfici (se disponibili)
-        if stats_immobiliare.get('superficie'):
-            superficie = stats_immobiliare['superficie']
-            prompt += f"""
-**Superfici (m²):**
-- Minima: {superficie.get('min', 0)} m²
-- Mediana: {superficie.get('mediano', 0)} m²
-- Massima: {superficie.get('max', 0)} m²
-"""
-        
-        # Prezzi al m² (se disponibili)
-        if stats_immobiliare.get('prezzo_mq'):
-            prezzo_mq = stats_immobiliare['prezzo_mq']
-            prompt += f"""
-**Prezzi al m²:**
-- Minimo: €{prezzo_mq.get('min', 0):,.0f}/m²
-- Mediano: €{prezzo_mq.get('mediano', 0):,.0f}/m²
-- Massimo: €{prezzo_mq.get('max', 0):,.0f}/m²
-"""
-        
-        # Agenzie immobiliari (se disponibili)
-        if stats_immobiliare.get('agenzie'):
-            prompt += "\n**Agenzie immobiliari:**\n"
-            # Prendi le top 5 agenzie (se agenzie è una lista di dict)
-            agenzie_list = stats_immobiliare['agenzie']
-            if isinstance(agenzie_list, list):
-                for agenzia in agenzie_list[:5]:
-                    nome_agenzia = agenzia.get('agenzia', 'N/D')
-                    count_agenzia = agenzia.get('count', 0)
-                    prompt += f"- {nome_agenzia}: {count_agenzia} appartamenti\n"
-        
-        # METRICHE DEVELOPER
-        n_app = stats_immobiliare.get('n_appartamenti', 0)
-        
-        prompt += "\n---\n\n**METRICHE DEVELOPER:**\n"
-        
-        # Saturazione mercato
-        if n_app < 10:
-            saturazione = "LIBERO (poca concorrenza)"
-        elif n_app < 30:
-            saturazione = "MEDIO (concorrenza normale)"
-        else:
-            saturazione = "SATURO (alta concorrenza)"
-        
-        prompt += f"""
-- Saturazione mercato: {saturazione}
-- Totale appartamenti in vendita: {n_app}
-"""
-        
-        # Concentrazione agenzie (se disponibile dataframe)
-        if stats_immobiliare.get('dataframe') is not None:
-            import pandas as pd
-            df = stats_immobiliare['dataframe']
-            agenzie_stats = df.groupby('agenzia').size()
-            top3_count = agenzie_stats.nlargest(3).sum()
-            top3_share = (top3_count / n_app * 100)
-            
-            if top3_share > 60:
-                concentrazione = "ALTA (pochi operatori dominanti)"
-            elif top3_share > 40:
-                concentrazione = "MEDIA (mix operatori)"
-            else:
-                concentrazione = "BASSA (mercato frammentato)"
-            
-            prompt += f"- Concentrazione Top 3 agenzie: {top3_share:.1f}% - {concentrazione}\n"
-    else:
-        prompt += "\n- Nessun dato disponibile dal mercato Immobiliare.it\n"
+    Returns:
+        Dict di errore se l'analisi non è possibile, None altrimenti
+    """
+    if not api_key:
+        return {
+            'success': False,
+            'error': 'API key Anthropic non configurata'
+        }
     
-    if gap_analysis:
-        prompt += f"""
----
-
-**GAP ANALYSIS:**
-- OMI Mediano: €{gap_analysis['omi_mediano']:,.0f}/m²
-- Mercato Mediano: €{gap_analysis['mercato_mediano']:,.0f}/m²
-- Gap Assoluto: €{gap_analysis['gap_assoluto']:,.0f}/m²
-- Gap Percentuale: {gap_analysis['gap_percentuale']:+.1f}%
-"""
+    # Verifica che ci siano dati da analizzare: un valore OMI o almeno un
+    # appartamento (dict presenti ma vuoti non bastano per un'analisi)
+    ha_omi = bool(zona_omi and zona_omi.get('val_med_mq'))
+    ha_mercato = bool(stats_immobiliare and stats_immobiliare.get('n_appartamenti', 0) > 0)
+    if not (ha_omi or ha_mercato):
+        return {
+            'success': False,
+            'error': 'Nessun dato disponibile per l\'analisi'
+        }
     
-    prompt += """
+    return None
 
----
 
-**ANALISI RICHIESTA:**
+def _estrai_raccomandazioni(analisi_completa: str) -> List[str]:
+    """
+    Estrae le raccomandazioni (lista puntata o numerata) dal testo generato
+    da Claude: i punti elenco che seguono la riga con "raccomandazioni",
+    fino al titolo della sezione successiva.
+    """
+    header = _RACC_HEADER_RE.search(analisi_completa)
+    if not header:
+        return []
+    
+    # La sezione inizia alla fine della riga del titolo
+    inizio = analisi_completa.find("\n", header.end())
+    if inizio == -1:
+        return []
+    
+    fine_sezione = _TITOLO_SEZIONE_RE.search(analisi_completa, inizio)
+    fine = fine_sezione.start() if fine_sezione else len(analisi_completa)
+    
+    return _PUNTO_ELENCO_RE.findall(analisi_completa, inizio, fine)
 
-Fornisci un'analisi professionale in italiano, strutturata in questo modo:
 
-## 1. SINTESI
-Panoramica generale della zona e del mercato (2-3 paragrafi)
-- Cosa emerge dai dati
-- Principale differenza tra valori OMI e prezzi di mercato
-
-## 2. CONFRONTO OMI vs MERCATO
-- Quanto è il gap percentuale tra OMI e mercato?
-- Cosa significa questo gap? (prezzi alti, allineati, o bassi?)
-- Perché c'è questa differenza?
+def _componi_risultato(analisi_completa: str, gap_analysis: Optional[Dict]) -> Dict:
+    """
+    Costruisce il dict di risultato a partire dal testo dell'analisi.
+    """
+    raccomandazioni = _estrai_raccomandazioni(analisi_completa)
+    
+    return {
+        'success': True,
+        'analisi_completa': analisi_completa,
+        'gap_analysis': gap_analysis,
+        'raccomandazioni': raccomandazioni if raccomandazioni else None
+    }
 
-## 3. ANALISI OFFERTA IMMOBILIARE.IT
-- Quanti appartamenti ci sono in vendita
-- Fascia di prezzo (entry level, medio, alto di gamma)
-- Come sono distribuiti i prezzi
-- Quali agenzie operano nella zona
 
-## 4. ANALISI DEVELOPER/INVESTITORI
-Usa le metriche Developer fornite per analizzare:
-- **Saturazione mercato**: Quanto è competitivo? (Libero/Medio/Saturo)
-- **Concentrazione agenzie**: Il mercato è frammentato o concentrato?
-- **Pricing strategy**: I prezzi attuali sono sostenibili? Gap OMI giustificato?
-- **Opportunità per developer**: È un buon momento per entrare nel mercato?
+def _risultato_errore(e: Exception) -> Dict:
+    """
+    Traduce un'eccezione dell'API in un dict di errore leggibile.
+    """
+    try:
+        import anthropic
+    except ImportError:
+        return {
+            'success': False,
+            'error': 'Libreria anthropic non installata. Esegui: pip install anthropic'
+        }
+    
+    if isinstance(e, anthropic.AuthenticationError):
+        return {
+            'success': False,
+            'error': 'API key non valida. Verifica la configurazione.'
+        }
+    if isinstance(e, anthropic.RateLimitError):
+        return {
+            'success': False,
+            'error': 'Limite rate API raggiunto. Riprova tra qualche minuto.'
+        }
+    return {
+        'success': False,
+        'error': f'Errore durante l\'analisi AI: {str(e)}'
+    }
 
-## 5. VALUTAZIONE DELLA ZONA
-- Come si posiziona questa zona rispetto ai valori OMI
-- È una zona economica, media o di prestigio?
-- Cosa giustifica i prezzi attuali
 
-## 6. CONSIGLI PRATICI
+@dataclass(slots=True)
+class _RichiestaAnalisi:
+    """Richiesta pronta per lo streaming (preparata da _inizia_analisi)."""
+    api_key: str
+    key: str
+    gap_analysis: Optional[Dict]
+    params: Dict  # argomenti di messages.stream
 
-**Per chi vuole comprare:**
-- Conviene comprare ora o aspettare?
-- I prezzi sono giusti o troppo alti?
-- Su cosa fare attenzione
 
-**Per chi vuole vendere:**
-- I prezzi richiesti sono realistici?
-- C'è margine per alzare/abbassare?
-- Come è la concorrenza
+def _inizia_analisi(
+    comune: str,
+    via: str,
+    zona_omi: Optional[Dict],
+    stats_immobiliare: Optional[Dict],
+    on_text: Optional[Callable[[str], None]],
+    rigenera: bool,
+    livello: str
+) -> Tuple[Optional[Dict], Optional[_RichiestaAnalisi]]:
+    """
+    Parte comune (senza rete) di analizza_con_ai e analizza_con_ai_async:
+    controlli sugli input, metriche, dati del prompt e lettura della cache.
+    
+    Returns:
+        (risultato, None) se la risposta è già pronta (errore o analisi in cache),
+        altrimenti (None, richiesta da inviare a Claude)
+    """
+    # Parametri del livello di analisi richiesto
+    if livello not in LIVELLI_ANALISI:
+        return {
+            'success': False,
+            'error': f"Livello di analisi sconosciuto: '{livello}' (validi: {', '.join(LIVELLI_ANALISI)})"
+        }, None
+    modello, max_tokens_livello, temperatura = LIVELLI_ANALISI[livello]
+    
+    # Recupera API key
+    api_key = get_api_key()
+    
+    errore = _verifica_input(api_key, zona_omi, stats_immobiliare)
+    if errore:
+        return errore, None
+    
+    try:
+        # Debug: stampa struttura dati ricevuti (solo se richiesto)
+        if DEBUG_MODE:
+            print(f"[DEBUG] zona_omi keys: {list(zona_omi) if zona_omi else None}")
+            print(f"[DEBUG] stats_immobiliare keys: {list(stats_immobiliare) if stats_immobiliare else None}")
+        
+        # Gap analysis, metriche e dati della zona (le istruzioni sono statiche)
+        metriche, dati_zona, key = _prepara_zona(comune, via, zona_omi, stats_immobiliare, livello)
+        
+        # Stesso prompt (stessi dati) => stessa analisi: evita la chiamata API
+        cached = None if rigenera else cache_get("analisi_ai", key, CACHE_TTL_ANALISI_AI)
+        if cached is not None:
+            if on_text:
+                on_text(cached['analisi_completa'])
+            return cached, None
+        
+        return None, _RichiestaAnalisi(
+            api_key=api_key,
+            key=key,
+            gap_analysis=metriche['gap'],
+            params={
+                'model': modello,
+                'max_tokens': min(_budget_token(zona_omi, metriche), max_tokens_livello),
+                'temperature': temperatura,
+                'messages': _messaggi_analisi(_PROMPT_ISTRUZIONI, dati_zona),
+            }
+        )
+        
+    except Exception as e:
+        return _risultato_errore(e), None
 
-**STILE:**
-- Scrivi in italiano semplice ma professionale
-- Usa i numeri concreti dall'analisi
-- Spiega i concetti tecnici in modo chiaro
-- Evita termini inglesi dove possibile
-- Dai consigli pratici e diretti
-- Non usare emoji
 
-**IMPORTANTE:** 
-Se alcuni dati mancano, dillo chiaramente e lavora con quello che hai.
-"""
-    
-    return prompt
+def _concludi_analisi(richiesta: _RichiestaAnalisi, chunks: List[str]) -> Dict:
+    """
+    Risultato dal testo ricevuto in streaming, salvato in cache.
+    """
+    risultato = _componi_risultato("".join(chunks), richiesta.gap_analysis)
+    cache_set("analisi_ai", richiesta.key, risultato)
+    return risultato
 
 
 def analizza_con_ai(
     comune: str,
     via: str,
     zona_omi: Optional[Dict],
-    stats_immobiliare: Optional[Dict]
+    stats_immobiliare: Optional[Dict],
+    on_text: Optional[Callable[[str], None]] = None,
+    rigenera: bool = False,
+    livello: str = "completa"
 ) -> Dict:
     """
-    Esegue l'analisi AI tramite Claude.
+    Esegue l'analisi AI tramite Claude (risposta ricevuta in streaming).
     
     Args:
         comune: Nome comune
         via: Nome via
         zona_omi: Dati OMI (dict o None)
         stats_immobiliare: Statistiche mercato (dict o None)
+        on_text: Callback chiamata con ogni frammento di testo appena ricevuto
+                 (per mostrare l'analisi man mano che viene generata)
+        rigenera: Se True ignora l'analisi in cache e la sostituisce con una nuova
+        livello: "completa" (default) o "rapida" (vedi LIVELLI_ANALISI)
     
     Returns:
         Dict con risultati analisi:
@@ -312,103 +847,141 @@ def analizza_con_ai(
             'error': str (se success=False)
         }
     """
-    # Recupera API key
-    api_key = get_api_key()
-    
-    if not api_key:
-        return {
-            'success': False,
-            'error': 'API key Anthropic non configurata'
-        }
-    
-    # Verifica che ci siano dati da analizzare
-    if not zona_omi and not stats_immobiliare:
-        return {
-            'success': False,
-            'error': 'Nessun dato disponibile per l\'analisi'
-        }
+    risultato, richiesta = _inizia_analisi(
+        comune, via, zona_omi, stats_immobiliare, on_text, rigenera, livello
+    )
+    if risultato is not None:
+        return risultato
     
     try:
-        # Debug: stampa struttura dati ricevuti
-        print(f"[DEBUG] zona_omi keys: {zona_omi.keys() if zona_omi else 'None'}")
-        print(f"[DEBUG] stats_immobiliare keys: {stats_immobiliare.keys() if stats_immobiliare else 'None'}")
-        
-        # Calcola gap analysis se possibile
-        gap_analysis = calcola_gap_analysis(zona_omi, stats_immobiliare)
+        # Client Anthropic condiviso (SDK importato solo quando serve)
+        client = _get_client(richiesta.api_key)
         
-        # Prepara prompt
-        prompt = prepara_prompt_analisi(
-            comune=comune,
-            via=via,
-            zona_omi=zona_omi,
-            stats_immobiliare=stats_immobiliare,
-            gap_analysis=gap_analysis
-        )
+        # Chiamata API in streaming: il testo arriva a frammenti
+        chunks = []
+        with client.messages.stream(**richiesta.params) as stream:
+            for text in stream.text_stream:
+                chunks.append(text)
+                if on_text:
+                    on_text(text)
         
-        # Inizializza client Anthropic
-        client = anthropic.Anthropic(api_key=api_key)
+        return _concludi_analisi(richiesta, chunks)
         
-        # Chiamata API
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            temperature=0.7,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        )
-        
-        # Estrai il testo della risposta
-        analisi_completa = message.content[0].text
+    except Exception as e:
+        return _risultato_errore(e)
+
+
+async def analizza_con_ai_async(
+    comune: str,
+    via: str,
+    zona_omi: Optional[Dict],
+    stats_immobiliare: Optional[Dict],
+    on_text: Optional[Callable[[str], None]] = None,
+    client=None,
+    rigenera: bool = False,
+    livello: str = "completa"
+) -> Dict:
+    """
+    Variante asincrona di analizza_con_ai, con risposta in streaming.
+    
+    Non blocca l'event loop durante la generazione e permette di lanciare
+    più analisi in parallelo con asyncio.gather.
+    
+    Args:
+        comune: Nome comune
+        via: Nome via
+        zona_omi: Dati OMI (dict o None)
+        stats_immobiliare: Statistiche mercato (dict o None)
+        on_text: Callback chiamata con ogni frammento di testo appena ricevuto
+                 (per mostrare l'analisi man mano che viene generata)
+        client: Client AsyncAnthropic da riutilizzare (es. da analizza_molti);
+                se assente ne viene creato uno per questa chiamata
+        rigenera: Se True ignora l'analisi in cache e la sostituisce con una nuova
+        livello: "completa" (default) o "rapida" (vedi LIVELLI_ANALISI)
+    
+    Returns:
+        Dict con la stessa struttura di analizza_con_ai
+    """
+    risultato, richiesta = _inizia_analisi(
+        comune, via, zona_omi, stats_immobiliare, on_text, rigenera, livello
+    )
+    if risultato is not None:
+        return risultato
+    
+    try:
+        # Client asincrono creato per chiamata: è legato all'event loop corrente
+        # e va chiuso qui (chi passa il proprio client lo chiude da sé)
+        client_proprio = client is None
+        if client_proprio:
+            client = _nuovo_client_async(richiesta.api_key)
         
-        # Prova a estrarre raccomandazioni (cerca sezione con lista puntata)
-        raccomandazioni = []
-        if "Raccomandazioni" in analisi_completa or "RACCOMANDAZIONI" in analisi_completa:
-            # Estrazione semplice delle raccomandazioni
-            lines = analisi_completa.split('\n')
-            in_raccomandazioni = False
-            for line in lines:
-                if 'raccomandazioni' in line.lower():
-                    in_raccomandazioni = True
-                    continue
-                if in_raccomandazioni:
-                    line = line.strip()
-                    if line.startswith('-') or line.startswith('*') or line.startswith('•'):
-                        racc = line.lstrip('-*•').strip()
-                        if racc:
-                            raccomandazioni.append(racc)
-                    elif line.startswith('#'):
-                        # Nuova sezione, stop
-                        break
+        chunks = []
+        try:
+            async with client.messages.stream(**richiesta.params) as stream:
+                async for text in stream.text_stream:
+                    chunks.append(text)
+                    if on_text:
+                        on_text(text)
+        finally:
+            if client_proprio:
+                await client.close()
         
-        return {
-            'success': True,
-            'analisi_completa': analisi_completa,
-            'gap_analysis': gap_analysis,
-            'raccomandazioni': raccomandazioni if raccomandazioni else None
-        }
+        return _concludi_analisi(richiesta, chunks)
         
-    except anthropic.AuthenticationError:
-        return {
-            'success': False,
-            'error': 'API key non valida. Verifica la configurazione.'
-        }
-    except anthropic.RateLimitError:
-        return {
-            'success': False,
-            'error': 'Limite rate API raggiunto. Riprova tra qualche minuto.'
-        }
     except Exception as e:
-        return {
-            'success': False,
-            'error': f'Errore durante l\'analisi AI: {str(e)}'
-        }
+        return _risultato_errore(e)
 
 
-if __name__ == "__main__":
+async def analizza_molti_async(
+    zone: List[Tuple[str, str, Optional[Dict], Optional[Dict]]],
+    livello: str = "completa"
+) -> List[Dict]:
+    """
+    Analizza più zone in parallelo (richieste indipendenti, una per zona).
+    
+    Le richieste si sovrappongono sull'event loop, al massimo
+    ANALISI_CONCORRENTI_MAX alla volta, condividendo un solo client.
+    
+    Args:
+        zone: Lista di (comune, via, zona_omi, stats_immobiliare)
+        livello: "completa" o "rapida" (vedi LIVELLI_ANALISI)
+    
+    Returns:
+        Lista di dict (stessa struttura di analizza_con_ai), nello stesso ordine
+    """
+    api_key = get_api_key()
+    semaforo = asyncio.Semaphore(ANALISI_CONCORRENTI_MAX)
+    
+    async def analizza_tutte(client) -> List[Dict]:
+        async def analizza_zona(comune, via, zona_omi, stats_immobiliare):
+            async with semaforo:
+                return await analizza_con_ai_async(
+                    comune, via, zona_omi, stats_immobiliare, client=client, livello=livello
+                )
+        
+        return list(await asyncio.gather(*(analizza_zona(*z) for z in zone)))
+    
+    # Senza API key ogni zona restituisce l'errore di _verifica_input
+    if not api_key:
+        return await analizza_tutte(None)
+    
+    # Client condiviso, chiuso (connessioni HTTP comprese) al termine di tutte le analisi
+    async with _nuovo_client_async(api_key) as client:
+        return await analizza_tutte(client)
+
+
+def analizza_molti(
+    zone: List[Tuple[str, str, Optional[Dict], Optional[Dict]]],
+    livello: str = "completa"
+) -> List[Dict]:
+    """
+    Versione sincrona di analizza_molti_async (da non chiamare dentro un
+    event loop già attivo).
+    """
+    return asyncio.run(analizza_molti_async(zone, livello))
+
+
+def _demo():
     """
     Test del modulo con dati di esempio
     """
@@ -452,4 +1025,8 @@ if __name__ == "__main__":
         print(f"Mercato Mediano: €{gap['mercato_mediano']:,.0f}/m²")
         print(f"Gap: {gap['gap_percentuale']:+.1f}%")
     
-    print("\n✅ Test completato!")
\ No newline at end of file
+    print("\n✅ Test completato!")
+
+
+if __name__ == "__main__":
+    _demo()
@@ -2,6 +2,7 @@ from __future__ import annotations
 import os
 import zipfile
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 # ==========================================
 # MODALITÀ DEBUG
@@ -20,6 +21,9 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Cartella per report / export
 REPORTS_DIR = os.path.join(BASE_DIR, "reports")
 
+# Cartella per la cache su disco (geocoding, scraping, analisi AI)
+CACHE_DIR = os.path.join(BASE_DIR, ".cache")
+
 # Cartella dove devono stare i dati OMI estratti
 OMI_DIR = os.path.join(BASE_DIR, "Omi")
 
@@ -33,6 +37,9 @@ OMI_ZONE_CSV_PATH = os.path.join(OMI_DIR, "QI_20251_ZONE.csv")
 # Cartella che contiene tutti i KML OMI (A001.kml ... M437.kml)
 OMI_KML_PATH = OMI_DIR
 
+# Archivi OMI estratti in parallelo (1 = estrazione sequenziale)
+OMI_UNZIP_WORKERS = min(8, os.cpu_count() or 1)
+
 
 # ==========================================
 # UTILITY FILESYSTEM
@@ -48,43 +55,125 @@ def _ensure_dir(path: str) -> None:
 # ESTRAZIONE AUTOMATICA DEI DATI OMI
 # ==========================================
 
+def _marker_estrazione(zpath: str) -> str:
+    """File sentinella scritto in Omi/ dopo l'estrazione completa di un archivio."""
+    return os.path.join(OMI_DIR, os.path.basename(zpath) + ".extracted")
+
+
+def _firma_zip(zpath: str) -> str:
+    """Firma dell'archivio (mtime:size): cambia se l'archivio viene sostituito."""
+    st = os.stat(zpath)
+    return f"{st.st_mtime}:{st.st_size}"
+
+
+def _zip_gia_estratto(zpath: str) -> bool:
+    """True se il marker esiste e corrisponde all'archivio attuale."""
+    try:
+        with open(_marker_estrazione(zpath), "r", encoding="utf-8") as f:
+            return f.read() == _firma_zip(zpath)
+    except OSError:
+        return False
+
+
+def _estrai_zip(zpath: str) -> None:
+    """Estrae un archivio in Omi/ e scrive il suo marker a estrazione riuscita."""
+    zname = os.path.basename(zpath)
+    try:
+        if DEBUG_MODE:
+            print(f"[OMI] Estraggo: {zname}")
+        with zipfile.ZipFile(zpath, "r") as zip_ref:
+            zip_ref.extractall(OMI_DIR)
+        # Marker scritto solo a estrazione riuscita
+        with open(_marker_estrazione(zpath), "w", encoding="utf-8") as f:
+            f.write(_firma_zip(zpath))
+    except Exception as e:
+        print(f"[OMI][ERROR] Errore durante l'estrazione di {zname}: {e}")
+
+
 def ensure_omi_unzipped() -> None:
     """
-    Se la cartella Omi/ non è inizializzata, estrae automaticamente
-    tutti gli archivi Omi_*.zip presenti nella root del progetto.
+    Estrae automaticamente gli archivi Omi_*.zip presenti nella root del
+    progetto nella cartella Omi/.
     Funziona sia in locale sia su Streamlit Cloud.
+
+    Ogni archivio estratto lascia un marker <nome>.extracted con la sua firma
+    (mtime:size): ai riavvii basta uno stat per archivio, e vengono estratti
+    solo gli archivi nuovi, modificati o la cui estrazione non era terminata.
+
+    Gli archivi contengono file distinti e vengono estratti in parallelo
+    (OMI_UNZIP_WORKERS thread: la decompressione zlib rilascia il GIL).
     """
     _ensure_dir(OMI_DIR)
 
-    # Se il CSV principale esiste già, assumiamo che sia tutto estratto
-    if os.path.exists(OMI_CSV_PATH):
-        if DEBUG_MODE:
-            print("[OMI] Cartella Omi già inizializzata. Nessuna estrazione necessaria.")
-        return
-
     zip_files = sorted(glob.glob(OMI_ZIP_GLOB))
 
     if not zip_files:
-        print("[OMI][WARN] Nessun archivio Omi_*.zip trovato. Dati OMI non disponibili.")
+        if not os.path.exists(OMI_CSV_PATH):
+            print("[OMI][WARN] Nessun archivio Omi_*.zip trovato. Dati OMI non disponibili.")
+        return
+
+    da_estrarre = [zpath for zpath in zip_files if not _zip_gia_estratto(zpath)]
+
+    if not da_estrarre:
+        if DEBUG_MODE:
+            print("[OMI] Cartella Omi già inizializzata. Nessuna estrazione necessaria.")
         return
 
     if DEBUG_MODE:
-        print(f"[OMI] Estraggo {len(zip_files)} archivi...")
-
-    for zpath in zip_files:
-        zname = os.path.basename(zpath)
-        try:
-            if DEBUG_MODE:
-                print(f"[OMI] Estraggo: {zname}")
-            with zipfile.ZipFile(zpath, "r") as zip_ref:
-                zip_ref.extractall(OMI_DIR)
-        except Exception as e:
-            print(f"[OMI][ERROR] Errore durante l'estrazione di {zname}: {e}")
+        print(f"[OMI] Estraggo {len(da_estrarre)} archivi...")
+
+    workers = min(OMI_UNZIP_WORKERS, len(da_estrarre))
+    if workers <= 1:
+        # Un solo archivio (o una sola CPU): estrazione sequenziale
+        for zpath in da_estrarre:
+            _estrai_zip(zpath)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_estrai_zip, da_estrarre))
 
     if DEBUG_MODE:
         print("[OMI] Estrazione completata.")
 
 
+# ==========================================
+# DURATA CACHE SU DISCO (secondi)
+# ==========================================
+
+# Geocoding Nominatim: gli indirizzi non cambiano (e la policy d'uso chiede di cachare)
+CACHE_TTL_GEOCODING = 30 * 24 * 3600
+
+# Annunci Immobiliare.it: l'offerta cambia nell'arco della giornata
+CACHE_TTL_SCRAPING = 6 * 3600
+
+# Risposte Claude a parità di prompt: il prompt contiene già tutti i dati
+# (OMI + mercato), quindi se i dati cambiano cambia anche la chiave
+CACHE_TTL_ANALISI_AI = 7 * 24 * 3600
+
+# HTML delle mappe Folium: la chiave contiene già tutti gli input della mappa;
+# serve a rigenerare lo stesso report, quindi basta una durata breve
+CACHE_TTL_MAPPE = 24 * 3600
+
+# Età massima delle voci per gruppo (namespace): oltre questa età le voci non
+# vengono solo ignorate in lettura ma cancellate dal database (vedi cache_utils).
+# I gruppi non elencati usano la durata più lunga.
+CACHE_TTL_NAMESPACE = {
+    "geocoding": CACHE_TTL_GEOCODING,
+    "immobiliare": CACHE_TTL_SCRAPING,
+    "immobiliare_pagina": CACHE_TTL_SCRAPING,
+    "analisi_ai": CACHE_TTL_ANALISI_AI,
+    "mappa_html": CACHE_TTL_MAPPE,
+}
+
+# Numero massimo di voci per i gruppi più voluminosi: oltre questo numero
+# vengono cancellate le voci più vecchie (anche se non ancora scadute)
+CACHE_MAX_VOCI = {
+    # Una voce per (coordinate, raggio, pagina): ~5 pagine per ricerca
+    "immobiliare_pagina": 200,
+    # HTML renderizzato: anche diversi MB per mappa
+    "mappa_html": 10,
+}
+
+
 # ==========================================
 # PARAMETRI DI MODELLO USATI DA agent_core
 # ==========================================
@@ -104,3 +193,11 @@ FATTORE_DEFAULT_SU_OMI = 1.25
 
 # Stringa informativa sui dati OMI usati
 OMI_DATA_INFO = "Dati OMI QI_20251 – Semestre 2025/1"
+
+
+# ==========================================
+# FORMATTAZIONE NUMERI (report e interfaccia)
+# ==========================================
+
+# Separatore migliaia italiano: "1,234,567" -> "1.234.567" (tabella creata una volta)
+MIGLIAIA_IT = str.maketrans(",", ".")
@@ -4,18 +4,21 @@ Geocoder Appartamenti - Aggiunge coordinate GPS agli appartamenti
 Geocoda gli indirizzi degli appartamenti trovati su Immobiliare.it
 """
 
-from geopy.geocoders import Nominatim
-from typing import List, Dict
 import time
+from typing import List, Dict
 
+# Geocoding condiviso con agent_core: cache su disco + Nominatim rate-limited
+from agent_core import geocode_batch, geocode_indirizzo
 
-# Geocoder
-_geolocator = Nominatim(user_agent="planet_ai_geocoder")
+# True per stampare l'esito di ogni singolo appartamento
+DEBUG_MODE = False
 
 
 def geocoda_appartamento(indirizzo: str, comune: str, timeout: int = 10) -> tuple[float, float]:
     """
     Geocoda un singolo indirizzo.
+    Gli indirizzi già geocodati (anche in esecuzioni precedenti) vengono letti
+    dalla cache su disco senza contattare Nominatim.
     
     Args:
         indirizzo: Indirizzo appartamento
@@ -28,17 +31,11 @@ def geocoda_appartamento(indirizzo: str, comune: str, timeout: int = 10) -> tupl
     if not indirizzo or indirizzo == "N/D":
         return (None, None)
     
-    try:
-        full_address = f"{indirizzo}, {comune}, Italia"
-        loc = _geolocator.geocode(full_address, timeout=timeout)
-        
-        if loc:
-            return (loc.latitude, loc.longitude)
-        else:
-            return (None, None)
-            
-    except Exception as e:
-        print(f"[GEOCODER][WARN] Errore geocoding '{indirizzo}': {e}")
+    lat, lon, geo_info = geocode_indirizzo(comune, indirizzo, timeout=timeout)
+    
+    if geo_info['success']:
+        return (lat, lon)
+    else:
         return (None, None)
 
 
@@ -46,10 +43,15 @@ def geocoda_appartamenti(appartamenti: List[Dict], comune: str, delay: float = 1
     """
     Aggiunge coordinate GPS a una lista di appartamenti.
     
+    Gli indirizzi vengono geocodati con agent_core.geocode_batch: in parallelo,
+    una volta per indirizzo distinto; quelli in cache rispondono subito, le
+    richieste reali passano dal RateLimiter condiviso e restano a 1 al secondo.
+    
     Args:
         appartamenti: Lista appartamenti da geocodare
         comune: Comune di riferimento
-        delay: Pausa tra richieste (per non sovraccaricare Nominatim)
+        delay: Non più usato: la pausa tra le richieste a Nominatim è gestita
+               dal RateLimiter condiviso (e gli indirizzi in cache non attendono)
     
     Returns:
         List[Dict]: Lista appartamenti con lat/lon aggiunti
@@ -57,52 +59,65 @@ def geocoda_appartamenti(appartamenti: List[Dict], comune: str, delay: float = 1
     if not appartamenti:
         return []
     
-    print(f"\n[GEOCODER] Geocoding {len(appartamenti)} appartamenti...")
+    inizio = time.perf_counter()
     
     # DEBUG: Mostra quali campi sono disponibili
-    if len(appartamenti) > 0:
+    if DEBUG_MODE:
         print(f"[GEOCODER][DEBUG] Campi disponibili nel primo appartamento: {list(appartamenti[0].keys())}")
     
+    # Prova TUTTI i possibili nomi campo per l'indirizzo
+    indirizzi = [
+        app.get('indirizzo') or 
+        app.get('via') or 
+        app.get('address') or 
+        app.get('location') or
+        app.get('localita') or
+        app.get('zona') or
+        app.get('title')  # A volte il titolo contiene l'indirizzo
+        for app in appartamenti
+    ]
+    
+    # Solo gli indirizzi disponibili vanno al geocoding (stesso ordine degli appartamenti)
+    coordinate = [(None, None)] * len(appartamenti)
+    validi = [
+        i for i, indirizzo in enumerate(indirizzi)
+        if isinstance(indirizzo, str) and indirizzo and indirizzo != 'N/D'
+    ]
+    risultati = geocode_batch(comune, [indirizzi[i] for i in validi], timeout=10)
+    for i, (lat, lon, geo_info) in zip(validi, risultati):
+        if geo_info['success']:
+            coordinate[i] = (lat, lon)
+    
     geocodati = 0
     falliti = 0
     
-    for i, app in enumerate(appartamenti, 1):
-        # Prova TUTTI i possibili nomi campo per l'indirizzo
-        indirizzo = (
-            app.get('indirizzo') or 
-            app.get('via') or 
-            app.get('address') or 
-            app.get('location') or
-            app.get('localita') or
-            app.get('zona') or
-            app.get('title')  # A volte il titolo contiene l'indirizzo
-        )
-        
+    for i, (app, indirizzo, (lat, lon)) in enumerate(zip(appartamenti, indirizzi, coordinate), 1):
         if indirizzo and indirizzo != 'N/D':
-            lat, lon = geocoda_appartamento(indirizzo, comune)
-            
             if lat and lon:
                 app['latitudine'] = lat
                 app['longitudine'] = lon
                 geocodati += 1
-                print(f"[GEOCODER] {i}/{len(appartamenti)}: ✓ {indirizzo[:40]}...")
+                if DEBUG_MODE:
+                    print(f"[GEOCODER] {i}/{len(appartamenti)}: ✓ {indirizzo[:40]}...")
             else:
                 app['latitudine'] = None
                 app['longitudine'] = None
                 falliti += 1
-                print(f"[GEOCODER] {i}/{len(appartamenti)}: ✗ {indirizzo[:40]}...")
+                if DEBUG_MODE:
+                    print(f"[GEOCODER] {i}/{len(appartamenti)}: ✗ {indirizzo[:40]}...")
         else:
             # Nessun indirizzo disponibile
             app['latitudine'] = None
             app['longitudine'] = None
             falliti += 1
-            print(f"[GEOCODER] {i}/{len(appartamenti)}: ✗ Indirizzo non disponibile")
-        
-        # Pausa per non sovraccaricare Nominatim
-        if i < len(appartamenti):
-            time.sleep(delay)
-    
-    print(f"[GEOCODER] Completato: {geocodati} geocodati, {falliti} falliti")
+            if DEBUG_MODE:
+                print(f"[GEOCODER] {i}/{len(appartamenti)}: ✗ Indirizzo non disponibile")
+    
+    # Un solo riepilogo per lista (niente I/O per ogni appartamento)
+    print(
+        f"[GEOCODER] {geocodati}/{len(appartamenti)} appartamenti geocodati "
+        f"({falliti} falliti) in {time.perf_counter() - inizio:.1f}s"
+    )
     
     return appartamenti
 
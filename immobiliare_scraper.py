@@ -3,15 +3,282 @@ Modulo per scraping dati da Immobiliare.it
 Estrae: Prezzo, MQ, Agenzia, Coordinate GPS per nuove costruzioni
 """
 
-import requests
 import time
-from typing import List, Dict, Optional
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache_utils import cache_get, cache_key, cache_set
+from config import CACHE_TTL_SCRAPING
+
+# True per stampare il primo annuncio completo e le coordinate trovate
+DEBUG_MODE = False
+
+# Parsing JSON delle risposte: orjson se disponibile, altrimenti json standard
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+
+# Sessione HTTP condivisa: riusa le connessioni TCP/TLS verso immobiliare.it
+# tra una pagina e l'altra (e tra una ricerca e l'altra)
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'application/json',
+    'Referer': 'https://www.immobiliare.it/search-list/',
+})
+
+# Ritentativi su 429/5xx con attesa esponenziale (0.5, 1, 2, 4, 8 s, al massimo
+# 32 s); un header Retry-After del server ha la precedenza.
+_RETRY_PARAMS = dict(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
+    raise_on_status=False,  # dopo i tentativi restituisce la risposta: la gestisce il chiamante
+)
+try:
+    # urllib3 >= 2: tetto all'attesa e jitter casuale (richieste parallele
+    # non ritentano tutte nello stesso istante)
+    _RETRY = Retry(**_RETRY_PARAMS, backoff_max=32, backoff_jitter=0.5)
+except TypeError:
+    _RETRY = Retry(**_RETRY_PARAMS)
+
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=_RETRY,
+))
+
+# Timeout separati (secondi): connessione breve, lettura più lunga per le
+# pagine con molti annunci
+HTTP_TIMEOUT = (5, 15)
+
+# Pagine scaricate in contemporanea dopo la prima (poche: il sito limita le richieste)
+PAGINE_PARALLELE = 3
+
+# Pausa di cortesia (secondi) prima di ogni richiesta reale al sito
+# (le pagine in cache non attendono)
+PAUSA_RICHIESTE = 0.25
+
+
+def _url_ricerca(lat: float, lon: float, raggio_km: float) -> Tuple[str, str]:
+    """
+    URL dell'API di ricerca, diviso attorno al numero di pagina.
+    Bounding box e parametri fissi sono calcolati una volta per ricerca:
+    l'URL di una pagina è prefisso + str(pagina) + suffisso.
+    
+    Returns:
+        Tuple (prefisso, suffisso)
+    """
+    import math
+    
+    base_url = "https://www.immobiliare.it/api-next/search-list/listings/"
+    
+    # Calcola bounding box corretto in base al raggio
+    # 1 grado di latitudine ≈ 111 km
+    # 1 grado di longitudine ≈ 111 km * cos(latitudine)
+    delta_lat = raggio_km / 111.0
+    delta_lon = raggio_km / (111.0 * math.cos(math.radians(lat)))
+    
+    min_lat = lat - delta_lat
+    max_lat = lat + delta_lat
+    min_lon = lon - delta_lon
+    max_lon = lon + delta_lon
+    
+    # Parametri prima e dopo 'pag' (l'ordine dei parametri resta quello dell'API)
+    params_prima = {
+        'raggio': str(int(raggio_km * 1000)),
+        'centro': f'{lat},{lon}',
+        'idContratto': '1',
+        'idCategoria': '6',
+        'idTipologia[0]': '54',  # Appartamenti
+        'idTipologia[1]': '85',  # Attici e Mansarde
+        '__lang': 'it',
+        'minLat': f'{min_lat:.6f}',
+        'maxLat': f'{max_lat:.6f}',
+        'minLng': f'{min_lon:.6f}',
+        'maxLng': f'{max_lon:.6f}',
+    }
+    params_dopo = {
+        'paramsCount': '7',
+        'path': '/search-list/',
+    }
+    
+    prefisso = base_url + '?' + '&'.join(f'{k}={v}' for k, v in params_prima.items()) + '&pag='
+    suffisso = '&' + '&'.join(f'{k}={v}' for k, v in params_dopo.items())
+    
+    return prefisso, suffisso
+
+
+def _scarica_pagina(url: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Scarica una pagina di risultati.
+    
+    Le pagine scaricate restano in cache (CACHE_TTL_SCRAPING): se una ricerca
+    si interrompe a metà, ripetendola non si riscaricano le pagine già ottenute.
+    
+    Returns:
+        (json della pagina, None) oppure (None, messaggio di errore)
+    """
+    key = cache_key(url)
+    cached = cache_get("immobiliare_pagina", key, CACHE_TTL_SCRAPING)
+    if cached is not None:
+        return cached, None
+    
+    try:
+        # Con PAGINE_PARALLELE thread: al massimo qualche richiesta al secondo
+        time.sleep(PAUSA_RICHIESTE)
+        response = _SESSION.get(url, timeout=HTTP_TIMEOUT)
+        
+        # Tentativi ripetuti dall'adapter (utile per tarare i ritentativi)
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            stati = [r.status for r in retries.history]
+            print(f"[SCRAPER][WARN] Pagina ottenuta dopo {len(stati)} ritentativi (HTTP {stati})")
+        
+        if response.status_code != 200:
+            return None, f"❌ Errore HTTP {response.status_code}"
+        
+        data = _json_loads(response.content)
+        
+        # Solo i campi usati (la risposta completa è molto più grande)
+        pagina = {
+            'results': data.get('results', []),
+            'totalAds': data.get('totalAds', 0),
+            # None se assente: il chiamante usa allora max_pagine
+            'maxPages': data.get('maxPages'),
+        }
+        if pagina['results']:
+            cache_set("immobiliare_pagina", key, pagina)
+        
+        return pagina, None
+        
+    except Exception as e:
+        return None, f"❌ Errore: {e}"
+
+
+# Dove cercare le coordinate in un annuncio, in ordine di priorità.
+# Ogni voce: (percorsi della latitudine, percorsi della longitudine);
+# vale la prima voce che ha una latitudine.
+_COORD_PATHS = (
+    # Opzione 1: location.latitude/longitude
+    ((('location', 'latitude'), ('location', 'lat')),
+     (('location', 'longitude'), ('location', 'lng'), ('location', 'lon'))),
+    # Opzione 2: properties[0].location
+    ((('properties', 0, 'location', 'latitude'), ('properties', 0, 'location', 'lat')),
+     (('properties', 0, 'location', 'longitude'), ('properties', 0, 'location', 'lng'))),
+    # Opzione 3: direttamente in real_estate
+    ((('latitude',), ('lat',)),
+     (('longitude',), ('lng',), ('lon',))),
+    # Opzione 4: geometry (GeoJSON è lon, lat)
+    ((('geometry', 'coordinates', 1),),
+     (('geometry', 'coordinates', 0),)),
+)
+
+
+def _primo_valore(obj, percorsi):
+    """Primo valore non vuoto tra i percorsi (chiavi/indici) dati, o None."""
+    for percorso in percorsi:
+        valore = obj
+        try:
+            for passo in percorso:
+                valore = valore[passo]
+        except (KeyError, IndexError, TypeError):
+            continue
+        if valore:
+            return valore
+    return None
+
+
+def _coordinate_annuncio(real_estate: Dict) -> Tuple[Optional[float], Optional[float]]:
+    """
+    (latitudine, longitudine) di un annuncio, o (None, None) se assenti.
+    """
+    for percorsi_lat, percorsi_lon in _COORD_PATHS:
+        latitudine = _primo_valore(real_estate, percorsi_lat)
+        if latitudine:
+            return latitudine, _primo_valore(real_estate, percorsi_lon)
+    return None, None
+
+
+def _estrai_appartamenti(results: List[Dict]) -> List[Dict]:
+    """
+    Estrae gli appartamenti (uno per proprietà con prezzo e mq validi)
+    dai risultati di una pagina.
+    """
+    appartamenti = []
+    
+    for idx, result in enumerate(results):
+        real_estate = result.get('realEstate') or {}
+        
+        # ID del progetto (per raggruppare appartamenti dello stesso annuncio)
+        progetto_id = real_estate.get('id', 'N/D')
+        
+        # COORDINATE GPS - CERCA IN TUTTI I POSTI POSSIBILI
+        latitudine, longitudine = _coordinate_annuncio(real_estate)
+        
+        # DEBUG
+        if DEBUG_MODE and idx == 0:
+            print(f"[SCRAPER][DEBUG] Coordinate trovate: lat={latitudine}, lon={longitudine}")
+        
+        # Agenzia
+        agenzia = "N/D"
+        advertiser = real_estate.get('advertiser') or {}
+        if advertiser:
+            agency = advertiser.get('agency') or {}
+            if agency:
+                agenzia = agency.get('displayName') or 'N/D'
+        
+        # Properties array
+        properties = real_estate.get('properties') or []
+        
+        for prop in properties:
+            if not isinstance(prop, dict):
+                continue
+            
+            # Prezzo
+            price_obj = prop.get('price') or {}
+            prezzo = price_obj.get('value')
+            
+            # MQ
+            surface = prop.get('surface') or ''
+            mq = None
+            if isinstance(surface, str) and surface:
+                mq_str = surface.replace(' m²', '').strip()
+                try:
+                    mq = int(mq_str)
+                except ValueError:
+                    pass
+            
+            # Salva solo se ha prezzo e mq validi
+            if prezzo and mq:
+                appartamenti.append({
+                    'progetto_id': progetto_id,
+                    'prezzo': prezzo,
+                    'mq': mq,
+                    'prezzo_mq': prezzo / mq,  # calcolato una volta sola
+                    'agenzia': agenzia,
+                    'latitudine': latitudine,  # NUOVO
+                    'longitudine': longitudine,  # NUOVO
+                })
+    
+    return appartamenti
 
 
 def cerca_appartamenti(lat: float, lon: float, raggio_km: float, max_pagine: int = 5) -> List[Dict]:
     """
     Chiama API Immobiliare.it e estrae appartamenti nuove costruzioni
     
+    La prima pagina indica quante pagine esistono (maxPages); le successive
+    vengono scaricate in parallelo (PAGINE_PARALLELE richieste alla volta,
+    sulla sessione condivisa) e poi elaborate in ordine. Se maxPages manca,
+    le pagine vengono scaricate una alla volta fino alla prima vuota.
+    
     Args:
         lat: Latitudine centro ricerca
         lon: Longitudine centro ricerca
@@ -21,180 +288,89 @@ def cerca_appartamenti(lat: float, lon: float, raggio_km: float, max_pagine: int
     Returns:
         Lista di dict con: progetto_id, prezzo, mq, agenzia, latitudine, longitudine
     """
-    import math
+    key = cache_key(round(lat, 5), round(lon, 5), raggio_km, max_pagine)
+    cached = cache_get("immobiliare", key, CACHE_TTL_SCRAPING)
+    if cached is not None:
+        print(f"✅ Immobiliare.it da cache: {len(cached)} appartamenti")
+        return cached
     
-    base_url = "https://www.immobiliare.it/api-next/search-list/listings/"
+    url_prefisso, url_suffisso = _url_ricerca(lat, lon, raggio_km)
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': 'application/json',
-        'Referer': 'https://www.immobiliare.it/search-list/',
-    }
+    def scarica(pagina: int) -> Tuple[Optional[Dict], Optional[str]]:
+        return _scarica_pagina(url_prefisso + str(pagina) + url_suffisso)
     
     appartamenti_totali = []
-    pagina = 1
     
     print(f"🔍 Inizio scraping Immobiliare.it (raggio {raggio_km} km)...")
     
-    while pagina <= max_pagine:
-        # Calcola bounding box corretto in base al raggio
-        # 1 grado di latitudine ≈ 111 km
-        # 1 grado di longitudine ≈ 111 km * cos(latitudine)
-        delta_lat = raggio_km / 111.0
-        delta_lon = raggio_km / (111.0 * math.cos(math.radians(lat)))
+    # Prima pagina: dice quante pagine ci sono (evita richieste a vuoto)
+    risposte = [scarica(1)]
+    prima, _ = risposte[0]
+    if prima is not None and prima.get('results'):
+        max_pages = prima.get('maxPages')
+        if max_pages:
+            # Numero di pagine noto: le successive in parallelo
+            ultima_pagina = min(max_pagine, max_pages)
+            if ultima_pagina > 1:
+                with ThreadPoolExecutor(max_workers=PAGINE_PARALLELE) as executor:
+                    risposte.extend(executor.map(scarica, range(2, ultima_pagina + 1)))
+        else:
+            # maxPages assente: niente richieste a vuoto in parallelo, una pagina
+            # alla volta (fino a max_pagine) finché arrivano risultati
+            for pagina in range(2, max_pagine + 1):
+                data, errore = scarica(pagina)
+                risposte.append((data, errore))
+                if errore or not data.get('results'):
+                    break
+    
+    completa = True
+    
+    for pagina, (data, errore) in enumerate(risposte, 1):
+        print(f"📄 Pagina {pagina}...", end=" ")
         
-        min_lat = lat - delta_lat
-        max_lat = lat + delta_lat
-        min_lon = lon - delta_lon
-        max_lon = lon + delta_lon
+        if errore:
+            print(errore)
+            completa = False
+            break
         
-        # Parametri per questa pagina
-        params = {
-            'raggio': str(int(raggio_km * 1000)),
-            'centro': f'{lat},{lon}',
-            'idContratto': '1',
-            'idCategoria': '6',
-            'idTipologia[0]': '54',  # Appartamenti
-            'idTipologia[1]': '85',  # Attici e Mansarde
-            '__lang': 'it',
-            'minLat': f'{min_lat:.6f}',
-            'maxLat': f'{max_lat:.6f}',
-            'minLng': f'{min_lon:.6f}',
-            'maxLng': f'{max_lon:.6f}',
-            'pag': str(pagina),
-            'paramsCount': '7',
-            'path': '/search-list/',
-        }
+        results = data.get('results', [])
         
-        url = base_url + '?' + '&'.join([f'{k}={v}' for k, v in params.items()])
+        print(f"✓ {len(results)} annunci")
         
-        print(f"📄 Pagina {pagina}...", end=" ")
+        # Info prima pagina
+        if pagina == 1:
+            total_ads = data.get('totalAds', 0)
+            max_pages = data.get('maxPages') or 'N/D'
+            print(f"   ℹ️  totalAds: {total_ads}, maxPages: {max_pages}")
         
+        if len(results) == 0:
+            print(f"   ⚠️  Pagina vuota - stop")
+            break
+        
+        # DEBUG: Stampa PRIMO result COMPLETO
+        if DEBUG_MODE and pagina == 1:
+            import json
+            print("[SCRAPER][DEBUG] === INIZIO JSON COMPLETO ===")
+            print(json.dumps(results[0], indent=2))
+            print("[SCRAPER][DEBUG] === FINE JSON COMPLETO ===")
+        
+        # Estrai dati da questa pagina: un annuncio malformato interrompe lo
+        # scraping ma tiene le pagine già estratte (senza metterle in cache)
         try:
-            response = requests.get(url, headers=headers, timeout=15)
-            
-            if response.status_code != 200:
-                print(f"❌ Errore HTTP {response.status_code}")
-                break
-            
-            data = response.json()
-            results = data.get('results', [])
-            
-            print(f"✓ {len(results)} annunci")
-            
-            # Info prima pagina
-            if pagina == 1:
-                total_ads = data.get('totalAds', 0)
-                max_pages = data.get('maxPages', 1)
-                print(f"   ℹ️  totalAds: {total_ads}, maxPages: {max_pages}")
-            
-            if len(results) == 0:
-                print(f"   ⚠️  Pagina vuota - stop")
-                break
-            
-            # Estrai dati da questa pagina
-            
-            # DEBUG: Stampa PRIMO result COMPLETO
-            if pagina == 1 and len(results) > 0:
-                import json
-                json_str = json.dumps(results[0], indent=2)
-                print("[SCRAPER][DEBUG] === INIZIO JSON COMPLETO ===")
-                # Stampa a pezzi per evitare troncamenti
-                for i in range(0, len(json_str), 3000):
-                    print(json_str[i:i+3000])
-                print("[SCRAPER][DEBUG] === FINE JSON COMPLETO ===")
-            
-            for idx, result in enumerate(results):
-                real_estate = result.get('realEstate', {})
-                
-                # ID del progetto (per raggruppare appartamenti dello stesso annuncio)
-                progetto_id = real_estate.get('id', 'N/D')
-                
-                # COORDINATE GPS - CERCA IN TUTTI I POSTI POSSIBILI
-                latitudine = None
-                longitudine = None
-                
-                # Opzione 1: location.latitude/longitude
-                location = real_estate.get('location', {})
-                if location:
-                    latitudine = location.get('latitude') or location.get('lat')
-                    longitudine = location.get('longitude') or location.get('lng') or location.get('lon')
-                
-                # Opzione 2: properties[0].location
-                if not latitudine and 'properties' in real_estate:
-                    props = real_estate.get('properties', [])
-                    if len(props) > 0:
-                        prop_loc = props[0].get('location', {})
-                        latitudine = prop_loc.get('latitude') or prop_loc.get('lat')
-                        longitudine = prop_loc.get('longitude') or prop_loc.get('lng')
-                
-                # Opzione 3: Direttamente in real_estate
-                if not latitudine:
-                    latitudine = real_estate.get('latitude') or real_estate.get('lat')
-                    longitudine = real_estate.get('longitude') or real_estate.get('lng') or real_estate.get('lon')
-                
-                # Opzione 4: geometry
-                if not latitudine and 'geometry' in real_estate:
-                    geom = real_estate.get('geometry', {})
-                    if 'coordinates' in geom:
-                        coords = geom.get('coordinates', [])
-                        if len(coords) >= 2:
-                            longitudine = coords[0]  # GeoJSON è lon, lat
-                            latitudine = coords[1]
-                
-                # DEBUG
-                if idx == 0:
-                    print(f"[SCRAPER][DEBUG] Coordinate trovate: lat={latitudine}, lon={longitudine}")
-                
-                # Agenzia
-                agenzia = "N/D"
-                advertiser = real_estate.get('advertiser', {})
-                if advertiser:
-                    agency = advertiser.get('agency', {})
-                    if agency:
-                        agenzia = agency.get('displayName', 'N/D')
-                
-                # Properties array
-                properties = real_estate.get('properties', [])
-                
-                for prop in properties:
-                    # Prezzo
-                    price_obj = prop.get('price', {})
-                    prezzo = price_obj.get('value')
-                    
-                    # MQ
-                    surface = prop.get('surface', '')
-                    mq = None
-                    if surface:
-                        mq_str = surface.replace(' m²', '').strip()
-                        try:
-                            mq = int(mq_str)
-                        except:
-                            pass
-                    
-                    # Salva solo se ha prezzo e mq validi
-                    if prezzo and mq:
-                        appartamenti_totali.append({
-                            'progetto_id': progetto_id,
-                            'prezzo': prezzo,
-                            'mq': mq,
-                            'agenzia': agenzia,
-                            'latitudine': latitudine,  # NUOVO
-                            'longitudine': longitudine,  # NUOVO
-                        })
-            
-            # Pausa tra pagine
-            if pagina < max_pagine:
-                time.sleep(1)
-            
-            pagina += 1
-            
+            appartamenti_totali.extend(_estrai_appartamenti(results))
         except Exception as e:
             print(f"❌ Errore pagina {pagina}: {e}")
+            completa = False
             break
     
     print(f"\n✅ Totale appartamenti estratti (prima rimozione duplicati): {len(appartamenti_totali)}\n")
     
+    # Uno scraping vuoto può essere un errore temporaneo: non lo mettiamo in cache.
+    # Nemmeno uno interrotto da un errore: la prossima ricerca riparte dalle
+    # pagine in cache e scarica solo quelle mancanti.
+    if appartamenti_totali and completa:
+        cache_set("immobiliare", key, appartamenti_totali)
+    
     return appartamenti_totali
 
 
@@ -227,32 +403,26 @@ def calcola_statistiche(appartamenti: List[Dict]) -> Dict:
     # Calcola prezzo/mq
     df['prezzo_mq'] = df['prezzo'] / df['mq']
     
+    # Media/mediana/min/max delle tre colonne in un'unica aggregazione
+    riepilogo = df[['prezzo', 'mq', 'prezzo_mq']].agg(['mean', 'median', 'min', 'max'])
+    nomi = {'mean': 'medio', 'median': 'mediano', 'min': 'min', 'max': 'max'}
+    
+    # Quota di mercato delle prime 3 agenzie: calcolata qui una sola volta,
+    # chi usa le statistiche (prompt AI, report) legge solo il valore
+    top3_share = float(df['agenzia'].value_counts().nlargest(3).sum() / len(df) * 100)
+    
     stats = {
         'n_appartamenti': len(df),
         'n_progetti': df['progetto_id'].nunique(),
-        'prezzo': {
-            'medio': df['prezzo'].mean(),
-            'mediano': df['prezzo'].median(),
-            'min': df['prezzo'].min(),
-            'max': df['prezzo'].max(),
-        },
-        'mq': {
-            'medio': df['mq'].mean(),
-            'mediano': df['mq'].median(),
-            'min': df['mq'].min(),
-            'max': df['mq'].max(),
-        },
-        'prezzo_mq': {
-            'medio': df['prezzo_mq'].mean(),
-            'mediano': df['prezzo_mq'].median(),
-            'min': df['prezzo_mq'].min(),
-            'max': df['prezzo_mq'].max(),
-        },
+        'prezzo': {nomi[k]: v for k, v in riepilogo['prezzo'].items()},
+        'mq': {nomi[k]: v for k, v in riepilogo['mq'].items()},
+        'prezzo_mq': {nomi[k]: v for k, v in riepilogo['prezzo_mq'].items()},
         'agenzie': df.groupby('agenzia').agg({
             'prezzo': ['count', 'mean'],
             'mq': 'mean',
             'progetto_id': 'nunique'
         }).reset_index().to_dict('records'),
+        'top3_share': top3_share,
         'dataframe': df  # Per ulteriori analisi
     }
     
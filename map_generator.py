@@ -8,12 +8,35 @@ Crea mappe con Folium mostrando:
 """
 
 import folium
+import numpy as np
 from folium import plugins
-import io
-from PIL import Image
-import pandas as pd
 from typing import Optional, Dict, List
 
+from cache_utils import cache_get, cache_key, cache_set
+from config import CACHE_TTL_MAPPE
+
+
+# Soglie (rapporto col prezzo/mq mediano) e colori CSS dei pin edificio:
+# verde < 0.85 <= blu < 1.15 <= arancione < 1.35 <= rosso
+_SOGLIE_PREZZO = (0.85, 1.15, 1.35)
+_COLORI_CSS = np.array(['#22c55e', '#3b82f6', '#f97316', '#ef4444'])
+
+# Pin edificio creato nel browser da FastMarkerCluster, una riga di dati per edificio:
+# [lat, lon, html icona, html popup, tooltip]. Un solo template Jinja per tutti
+# i pin invece di Marker + DivIcon + Popup + Tooltip per ognuno.
+_CALLBACK_PIN_EDIFICIO = """function (row) {
+    var icon = L.divIcon({html: row[2], className: 'empty'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[3], {maxWidth: 300});
+    marker.bindTooltip(row[4], {sticky: true});
+    return marker;
+}"""
+
+# Zoom iniziale della mappa: da questo zoom in su i pin non vengono raggruppati,
+# quindi la vista iniziale mostra ogni edificio col suo colore; i gruppi
+# compaiono solo allontanandosi
+_ZOOM_INIZIALE = 14
+
 
 def get_color_by_price(prezzo_mq: float, stats: Dict) -> str:
     """
@@ -38,6 +61,36 @@ def get_color_by_price(prezzo_mq: float, stats: Dict) -> str:
         return 'red'    # Molto alto
 
 
+def _colori_edifici(prezzi_mq_medi: List[float], stats: Optional[Dict]) -> np.ndarray:
+    """
+    Colore CSS dei pin per tutti gli edifici in un solo passaggio vettoriale.
+    Stesse soglie di get_color_by_price; senza statistiche tutti blu.
+    """
+    if not stats:
+        return np.full(len(prezzi_mq_medi), _COLORI_CSS[1])
+    
+    mediano = stats['prezzo_mq']['mediano']
+    pmq = np.asarray(prezzi_mq_medi, dtype=np.float64)
+    indici = np.select(
+        [pmq < mediano * soglia for soglia in _SOGLIE_PREZZO],
+        [0, 1, 2],
+        default=3
+    )
+    return _COLORI_CSS[indici]
+
+
+def _prezzo_mq(app: Dict) -> float:
+    """
+    Prezzo/mq di un appartamento.
+    Usa il valore precalcolato dallo scraper se presente.
+    """
+    prezzo_mq = app.get('prezzo_mq')
+    if prezzo_mq is None:
+        mq = app.get('mq', 0)
+        prezzo_mq = app.get('prezzo', 0) / mq if mq > 0 else 0
+    return prezzo_mq
+
+
 def crea_mappa_interattiva(
     lat_centro: float,
     lon_centro: float,
@@ -66,7 +119,7 @@ def crea_mappa_interattiva(
     # Crea mappa centrata sul punto di ricerca
     mappa = folium.Map(
         location=[lat_centro, lon_centro],
-        zoom_start=14,
+        zoom_start=_ZOOM_INIZIALE,
         tiles='OpenStreetMap'
     )
     
@@ -109,63 +162,63 @@ def crea_mappa_interattiva(
         print(f"[MAP] {len(edifici)} edifici diversi con {len(appartamenti)} appartamenti totali")
         
         # PIN EDIFICI (raggruppati)
+        # Primo passaggio: popup e medie per edificio; i colori sono
+        # calcolati dopo, tutti insieme, con _colori_edifici
         appartamenti_con_coord = 0
+        pin_edifici = []
+        prezzi_mq_medi = []
         for (lat_edificio, lon_edificio), apps_edificio in edifici.items():
             n_apps = len(apps_edificio)
             appartamenti_con_coord += n_apps
             
-            # Calcola prezzo medio dell'edificio
-            prezzi = [a['prezzo'] for a in apps_edificio]
-            prezzo_medio_edificio = sum(prezzi) / len(prezzi)
-            
-            # Calcola prezzo/mq medio per determinare colore
-            if stats_immobiliare:
-                prezzi_mq = [a['prezzo']/a['mq'] for a in apps_edificio if a.get('mq', 0) > 0]
-                prezzo_mq_medio = sum(prezzi_mq) / len(prezzi_mq) if prezzi_mq else 0
-                color = get_color_by_price(prezzo_mq_medio, stats_immobiliare)
-            else:
-                color = 'blue'
+            # Un solo passaggio sugli appartamenti dell'edificio:
+            # somme per prezzo medio e prezzo/mq medio + righe del popup
+            somma_prezzi = 0
+            somma_prezzi_mq = 0
+            n_prezzi_mq = 0
             
             # HTML popup con LISTA appartamenti
-            popup_html = f"""
+            popup_parts = [f"""
             <div style="width:280px; max-height:400px; overflow-y:auto">
                 <b>🏢 {n_apps} Appartament{'o' if n_apps == 1 else 'i'}</b>
                 <hr style="margin:5px 0">
-            """
+            """]
             
             for idx, app in enumerate(apps_edificio, 1):
                 agenzia = app.get('agenzia', 'N/D')
                 prezzo = app.get('prezzo', 0)
                 mq = app.get('mq', 0)
-                prezzo_mq = int(prezzo / mq) if mq > 0 else 0
+                prezzo_mq_app = _prezzo_mq(app)
+                prezzo_mq = int(prezzo_mq_app)
+                
+                somma_prezzi += prezzo
+                if mq > 0:
+                    somma_prezzi_mq += prezzo_mq_app
+                    n_prezzi_mq += 1
                 
-                popup_html += f"""
+                popup_parts.append(f"""
                 <div style="border-bottom:1px solid #eee; padding:5px 0; font-size:11px">
                     <b>Unità #{idx}</b><br>
                     💰 <b>€{prezzo:,}</b><br>
                     📐 {mq} m² · €{prezzo_mq:,}/m²<br>
                     🏢 {agenzia[:30]}
                 </div>
-                """
-            
-            popup_html += "</div>"
+                """)
             
-            # Determina colore CSS per il pin
-            if color == 'green':
-                bg_color = '#22c55e'
-            elif color == 'blue':
-                bg_color = '#3b82f6'
-            elif color == 'orange':
-                bg_color = '#f97316'
-            else:  # red
-                bg_color = '#ef4444'
+            popup_parts.append("</div>")
+            popup_html = "".join(popup_parts)
             
+            prezzo_medio_edificio = somma_prezzi / n_apps
+            pin_edifici.append((lat_edificio, lon_edificio, n_apps, popup_html, prezzo_medio_edificio))
+            prezzi_mq_medi.append(somma_prezzi_mq / n_prezzi_mq if n_prezzi_mq else 0)
+        
+        # Colore CSS per ogni edificio in base al prezzo/mq medio
+        colori_edifici = _colori_edifici(prezzi_mq_medi, stats_immobiliare)
+        
+        righe_pin = []
+        for (lat_edificio, lon_edificio, n_apps, popup_html, prezzo_medio_edificio), bg_color in zip(pin_edifici, colori_edifici):
             # Icona con NUMERO di appartamenti
-            folium.Marker(
-                location=[lat_edificio, lon_edificio],
-                popup=folium.Popup(popup_html, max_width=300),
-                tooltip=f"{n_apps} app. - €{int(prezzo_medio_edificio):,} - [{lat_edificio:.5f}, {lon_edificio:.5f}]",
-                icon=folium.DivIcon(html=f"""
+            icona_html = f"""
                     <div style="
                         background-color: {bg_color};
                         border: 2px solid white;
@@ -180,7 +233,16 @@ def crea_mappa_interattiva(
                         font-size: 14px;
                         box-shadow: 0 2px 5px rgba(0,0,0,0.4);
                     ">{n_apps}</div>
-                """)
+                """
+            tooltip = f"{n_apps} app. - €{int(prezzo_medio_edificio):,} - [{lat_edificio:.5f}, {lon_edificio:.5f}]"
+            righe_pin.append([lat_edificio, lon_edificio, icona_html, popup_html, tooltip])
+        
+        # Tutti i pin edificio in un colpo solo, raggruppati a zoom bassi
+        if righe_pin:
+            plugins.FastMarkerCluster(
+                data=righe_pin,
+                callback=_CALLBACK_PIN_EDIFICIO,
+                disableClusteringAtZoom=_ZOOM_INIZIALE
             ).add_to(mappa)
         
         print(f"[MAP] Appartamenti con coordinate aggiunti alla mappa: {appartamenti_con_coord}/{len(appartamenti)}")
@@ -200,6 +262,7 @@ def crea_mappa_interattiva(
         <span style="color:red">●</span> Molto alto (&gt;+35% mediano)<br>
         <hr style="margin:3px 0">
         <b>Numero sul pin:</b> appartamenti nell'edificio<br>
+        <b>Cerchi di gruppo:</b> più edifici vicini (solo con zoom ridotto)<br>
         <i class="fa fa-home" style="color:red"></i> Centro ricerca<br>
     </div>
     '''
@@ -211,6 +274,56 @@ def crea_mappa_interattiva(
     return mappa
 
 
+def salva_mappa_html(
+    output_path: str,
+    lat_centro: float,
+    lon_centro: float,
+    via: str,
+    comune: str,
+    raggio_km: float,
+    appartamenti: List[Dict],
+    stats_immobiliare: Optional[Dict] = None
+) -> str:
+    """
+    Crea la mappa interattiva e la salva come HTML.
+    L'HTML generato viene messo in cache con una chiave calcolata sugli
+    input: rigenerare il report con gli stessi dati non ricostruisce la mappa.
+    
+    Args:
+        output_path: Percorso file HTML di output
+        (altri argomenti come crea_mappa_interattiva)
+    
+    Returns:
+        str: Percorso file salvato
+    """
+    # Delle statistiche la mappa usa solo il mediano (colore dei pin)
+    mediano = stats_immobiliare['prezzo_mq']['mediano'] if stats_immobiliare else None
+    key = cache_key(folium.__version__, lat_centro, lon_centro, via, comune,
+                    raggio_km, appartamenti, mediano)
+    
+    html = cache_get("mappa_html", key, CACHE_TTL_MAPPE)
+    if html is None:
+        mappa = crea_mappa_interattiva(
+            lat_centro=lat_centro,
+            lon_centro=lon_centro,
+            via=via,
+            comune=comune,
+            raggio_km=raggio_km,
+            appartamenti=appartamenti,
+            stats_immobiliare=stats_immobiliare
+        )
+        html = mappa.get_root().render()
+        cache_set("mappa_html", key, html)
+    else:
+        print(f"[MAP] Mappa da cache ({len(appartamenti)} appartamenti)")
+    
+    # Stesso contenuto che scriverebbe mappa.save(output_path)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    
+    return output_path
+
+
 def salva_mappa_come_immagine(
     mappa: folium.Map,
     output_path: str,
@@ -268,14 +381,22 @@ def get_mappa_statistiche(appartamenti: List[Dict]) -> Dict:
             'senza_coordinate': len(appartamenti)
         }
     
+    # Matrice (n, 2) lat/lon: min e max per colonna in C invece di quattro generatori
+    coordinate = np.array(
+        [(app['latitudine'], app['longitudine']) for app in appartamenti_con_coord],
+        dtype=np.float64
+    )
+    lat_min, lon_min = coordinate.min(axis=0)
+    lat_max, lon_max = coordinate.max(axis=0)
+    
     return {
         'totale': len(appartamenti),
         'con_coordinate': len(appartamenti_con_coord),
         'senza_coordinate': len(appartamenti) - len(appartamenti_con_coord),
-        'lat_min': min(app['latitudine'] for app in appartamenti_con_coord),
-        'lat_max': max(app['latitudine'] for app in appartamenti_con_coord),
-        'lon_min': min(app['longitudine'] for app in appartamenti_con_coord),
-        'lon_max': max(app['longitudine'] for app in appartamenti_con_coord),
+        'lat_min': float(lat_min),
+        'lat_max': float(lat_max),
+        'lon_min': float(lon_min),
+        'lon_max': float(lon_max),
     }
 
 
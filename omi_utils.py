@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import glob
 import re
+import threading
 import xml.etree.ElementTree as ET
 from dataclasses import dataclass
 from typing import List, Optional, Dict, Tuple
@@ -34,6 +35,19 @@ class OMIQuotazione:
     val_max_mq: Optional[float]
 
 
+# =====================================================
+# Pattern di parsing (compilati una sola volta)
+# =====================================================
+
+# "COMO (CO) Anno/Semestre 2025/1 generato il ..."
+_DOC_NAME_RE = re.compile(r"^(.*?)\s+\((..)\)")
+# "...Zona OMI B1"
+_ZONA_OMI_RE = re.compile(r"ZONA\s+OMI\s+([A-Z0-9]+)")
+
+# "1.234,56" -> "1234.56" in un solo passaggio
+_MIGLIAIA_IT_TRANS = str.maketrans({".": None, ",": "."})
+
+
 # =====================================================
 # Cache in memoria
 # =====================================================
@@ -44,6 +58,8 @@ _omi_polygons: List[Dict] = []
 _omi_valori_df: Optional[pd.DataFrame] = None
 _omi_zone_df: Optional[pd.DataFrame] = None
 _omi_cache_ready: bool = False
+# Il warmup può partire in un thread in background: un solo caricamento alla volta
+_omi_cache_lock = threading.Lock()
 
 
 # =====================================================
@@ -66,7 +82,7 @@ def _safe_float(x) -> Optional[float]:
 
     # Gestione migliaia + virgola decimale (es: "1.234,56")
     if s.count(",") == 1 and s.count(".") > 1:
-        s = s.replace(".", "").replace(",", ".")
+        s = s.translate(_MIGLIAIA_IT_TRANS)
     else:
         s = s.replace(",", ".")
 
@@ -103,7 +119,7 @@ def _parse_kml_file(path: str) -> List[Dict]:
     doc_name_el = root.find(".//k:Document/k:name", ns)
     if doc_name_el is not None and doc_name_el.text:
         txt = doc_name_el.text.strip()
-        m = re.match(r"^(.*?)\s+\((..)\)", txt)
+        m = _DOC_NAME_RE.match(txt)
         if m:
             comune = m.group(1).strip().upper()
             prov = m.group(2).strip().upper()
@@ -126,7 +142,7 @@ def _parse_kml_file(path: str) -> List[Dict]:
         if not zona_code:
             name_el = pm.find("k:name", ns)
             if name_el is not None and name_el.text:
-                m = re.search(r"ZONA\s+OMI\s+([A-Z0-9]+)", name_el.text.upper())
+                m = _ZONA_OMI_RE.search(name_el.text.upper())
                 if m:
                     zona_code = m.group(1)
 
@@ -141,9 +157,7 @@ def _parse_kml_file(path: str) -> List[Dict]:
 
             coords_text = coords_el.text.strip()
             ring: List[Tuple[float, float]] = []
-            for part in re.split(r"\s+", coords_text):
-                if not part:
-                    continue
+            for part in coords_text.split():
                 bits = part.split(",")
                 if len(bits) < 2:
                     continue
@@ -403,16 +417,22 @@ def _get_valori_for_zona(
 def warmup_omi_cache() -> None:
     """
     Pre-carica KML + CSV in memoria. Da chiamare una sola volta all'avvio.
+    Thread-safe: se il caricamento è già in corso in un altro thread,
+    attende che finisca invece di ripeterlo.
     """
     global _omi_cache_ready
     if _omi_cache_ready:
         return
 
-    ensure_omi_unzipped()
-    _load_omi_csvs()
-    _load_omi_polygons()
+    with _omi_cache_lock:
+        if _omi_cache_ready:
+            return
+
+        ensure_omi_unzipped()
+        _load_omi_csvs()
+        _load_omi_polygons()
 
-    _omi_cache_ready = True
+        _omi_cache_ready = True
 
     if DEBUG_MODE:
         print("[OMI] Cache OMI inizializzata.")
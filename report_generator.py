@@ -6,14 +6,27 @@ Generatore report Word combinato:
 """
 
 import os
+import re
 from datetime import datetime
 from typing import Dict, Optional
-import pandas as pd
 
-from docx import Document
-from docx.shared import Pt, RGBColor, Inches
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from map_generator import crea_mappa_interattiva
+from config import MIGLIAIA_IT
+
+
+# Caratteri non ammessi nei nomi file (spazi, separatori di percorso, riservati Windows)
+_NOME_FILE_NON_SICURO = re.compile(r'[\s/\\:*?"<>|]')
+
+
+def _righe_tabella(table) -> list:
+    """
+    Restituisce le celle di una tabella docx raggruppate per riga.
+    
+    table._cells viene letto una sola volta: ogni accesso a
+    table.rows[i].cells riscorre l'intera griglia XML della tabella.
+    """
+    celle = table._cells
+    n_col = len(table.columns)
+    return [celle[i:i + n_col] for i in range(0, len(celle), n_col)]
 
 
 def genera_report_combinato(
@@ -27,7 +40,7 @@ def genera_report_combinato(
     appartamenti: Optional[list] = None,
     analisi_ai: Optional[Dict] = None,
     output_dir: str = "reports"
-) -> str:
+) -> Optional[str]:
     """
     Genera report Word combinato con dati OMI + Immobiliare.it
     
@@ -43,11 +56,25 @@ def genera_report_combinato(
         output_dir: Directory output
     
     Returns:
-        Path del file generato
+        Path del file generato, oppure None se non c'è alcun dato da riportare
     """
     
+    # Nessun dato (né OMI, né mercato, né analisi AI): non costruire il documento
+    ha_dati = zona_omi or stats_immobiliare or appartamenti or (analisi_ai and analisi_ai.get('success'))
+    if not ha_dati:
+        print("[REPORT][WARN] Nessun dato disponibile: report non generato")
+        return None
+    
+    # Import al primo utilizzo: python-docx serve solo quando si genera un report
+    from docx import Document
+    from docx.shared import Pt, RGBColor
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    
     print("\n📝 Generazione report Word combinato...")
     
+    # Nome comune utilizzabile nei nomi dei file (report e mappa)
+    comune_file = _NOME_FILE_NON_SICURO.sub('_', comune.strip())
+    
     # Crea documento
     doc = Document()
     
@@ -81,6 +108,7 @@ def genera_report_combinato(
     
     info_table = doc.add_table(rows=5, cols=2)
     info_table.style = 'Light Grid Accent 1'
+    righe = _righe_tabella(info_table)
     
     info_data = [
         ['Data estrazione', now.strftime('%d/%m/%Y %H:%M')],
@@ -91,9 +119,9 @@ def genera_report_combinato(
     ]
     
     for i, (label, value) in enumerate(info_data):
-        info_table.rows[i].cells[0].text = label
-        info_table.rows[i].cells[1].text = value
-        info_table.rows[i].cells[0].paragraphs[0].runs[0].font.bold = True
+        righe[i][0].text = label
+        righe[i][1].text = value
+        righe[i][0].paragraphs[0].runs[0].font.bold = True
     
     doc.add_paragraph()
     
@@ -113,22 +141,23 @@ def genera_report_combinato(
         
         omi_table = doc.add_table(rows=2, cols=3)
         omi_table.style = 'Light Grid Accent 1'
+        righe = _righe_tabella(omi_table)
         
         # Header
         headers = ['Minimo', 'Mediano', 'Massimo']
         for i, header in enumerate(headers):
-            cell = omi_table.rows[0].cells[i]
+            cell = righe[0][i]
             cell.text = header
             cell.paragraphs[0].runs[0].font.bold = True
             cell.paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
         
         # Valori
-        omi_table.rows[1].cells[0].text = f"€{zona_omi['val_min_mq']:,.0f}".replace(',', '.')
-        omi_table.rows[1].cells[1].text = f"€{zona_omi['val_med_mq']:,.0f}".replace(',', '.')
-        omi_table.rows[1].cells[2].text = f"€{zona_omi['val_max_mq']:,.0f}".replace(',', '.')
+        righe[1][0].text = f"€{zona_omi['val_min_mq']:,.0f}".translate(MIGLIAIA_IT)
+        righe[1][1].text = f"€{zona_omi['val_med_mq']:,.0f}".translate(MIGLIAIA_IT)
+        righe[1][2].text = f"€{zona_omi['val_max_mq']:,.0f}".translate(MIGLIAIA_IT)
         
         for i in range(3):
-            omi_table.rows[1].cells[i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+            righe[1][i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
     else:
         doc.add_paragraph('⚠️ Dati OMI non disponibili per questa zona.')
     
@@ -145,10 +174,10 @@ def genera_report_combinato(
         
         # Statistiche Prezzi
         doc.add_paragraph('Statistiche Prezzi:', style='Heading 3')
-        doc.add_paragraph(f"Prezzo medio: €{stats_immobiliare['prezzo']['medio']:,.0f}".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo mediano: €{stats_immobiliare['prezzo']['mediano']:,.0f}".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo minimo: €{stats_immobiliare['prezzo']['min']:,.0f}".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo massimo: €{stats_immobiliare['prezzo']['max']:,.0f}".replace(',', '.'))
+        doc.add_paragraph(f"Prezzo medio: €{stats_immobiliare['prezzo']['medio']:,.0f}".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo mediano: €{stats_immobiliare['prezzo']['mediano']:,.0f}".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo minimo: €{stats_immobiliare['prezzo']['min']:,.0f}".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo massimo: €{stats_immobiliare['prezzo']['max']:,.0f}".translate(MIGLIAIA_IT))
         doc.add_paragraph()
         
         # Statistiche Superfici
@@ -161,10 +190,10 @@ def genera_report_combinato(
         
         # Prezzo al MQ
         doc.add_paragraph('Prezzo al Metro Quadro:', style='Heading 3')
-        doc.add_paragraph(f"Prezzo/mq medio: €{stats_immobiliare['prezzo_mq']['medio']:,.0f}/m²".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo/mq mediano: €{stats_immobiliare['prezzo_mq']['mediano']:,.0f}/m²".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo/mq minimo: €{stats_immobiliare['prezzo_mq']['min']:,.0f}/m²".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo/mq massimo: €{stats_immobiliare['prezzo_mq']['max']:,.0f}/m²".replace(',', '.'))
+        doc.add_paragraph(f"Prezzo/mq medio: €{stats_immobiliare['prezzo_mq']['medio']:,.0f}/m²".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo/mq mediano: €{stats_immobiliare['prezzo_mq']['mediano']:,.0f}/m²".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo/mq minimo: €{stats_immobiliare['prezzo_mq']['min']:,.0f}/m²".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo/mq massimo: €{stats_immobiliare['prezzo_mq']['max']:,.0f}/m²".translate(MIGLIAIA_IT))
         doc.add_paragraph()
         
         # Distribuzione per fasce prezzo
@@ -220,25 +249,26 @@ def genera_report_combinato(
         # Tabella agenzie
         table = doc.add_table(rows=len(agenzie)+1, cols=4)
         table.style = 'Light Grid Accent 1'
+        righe = _righe_tabella(table)
         
         # Header
         headers = ['Agenzia', 'N° Appartamenti', 'Prezzo Medio', 'MQ Medio']
         for i, header in enumerate(headers):
-            cell = table.rows[0].cells[i]
+            cell = righe[0][i]
             cell.text = header
             cell.paragraphs[0].runs[0].font.bold = True
             cell.paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
         
         # Dati
         for idx, row in agenzie.iterrows():
-            table.rows[idx+1].cells[0].text = str(row['Agenzia'])
-            table.rows[idx+1].cells[1].text = str(int(row['N° Appartamenti']))
-            table.rows[idx+1].cells[2].text = f"€{row['Prezzo Medio']:,.0f}".replace(',', '.')
-            table.rows[idx+1].cells[3].text = f"{row['MQ Medio']:.0f} m²"
+            righe[idx+1][0].text = str(row['Agenzia'])
+            righe[idx+1][1].text = str(int(row['N° Appartamenti']))
+            righe[idx+1][2].text = f"€{row['Prezzo Medio']:,.0f}".translate(MIGLIAIA_IT)
+            righe[idx+1][3].text = f"{row['MQ Medio']:.0f} m²"
             
-            table.rows[idx+1].cells[1].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
-            table.rows[idx+1].cells[2].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            table.rows[idx+1].cells[3].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.RIGHT
+            righe[idx+1][1].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+            righe[idx+1][2].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.RIGHT
+            righe[idx+1][3].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.RIGHT
         
         doc.add_paragraph()
     
@@ -257,15 +287,16 @@ def genera_report_combinato(
         
         sat_table = doc.add_table(rows=1, cols=2)
         sat_table.style = 'Light Grid Accent 1'
+        righe = _righe_tabella(sat_table)
         
         sat_data = [
             ['Appartamenti in Vendita (Nuove Costruzioni)', str(n_app)]
         ]
         
         for i, (label, value) in enumerate(sat_data):
-            sat_table.rows[i].cells[0].text = label
-            sat_table.rows[i].cells[0].paragraphs[0].runs[0].font.bold = True
-            sat_table.rows[i].cells[1].text = value
+            righe[i][0].text = label
+            righe[i][0].paragraphs[0].runs[0].font.bold = True
+            righe[i][1].text = value
         
         doc.add_paragraph()
         
@@ -289,6 +320,7 @@ def genera_report_combinato(
         
         price_table = doc.add_table(rows=5, cols=2)
         price_table.style = 'Light Grid Accent 1'
+        righe = _righe_tabella(price_table)
         
         price_data = [
             ['OMI Mediano (Baseline)', f"€{omi_med:,.0f}/m²"],
@@ -299,9 +331,9 @@ def genera_report_combinato(
         ]
         
         for i, (label, value) in enumerate(price_data):
-            price_table.rows[i].cells[0].text = label
-            price_table.rows[i].cells[0].paragraphs[0].runs[0].font.bold = True
-            price_table.rows[i].cells[1].text = value.replace(',', '.')
+            righe[i][0].text = label
+            righe[i][0].paragraphs[0].runs[0].font.bold = True
+            righe[i][1].text = value.translate(MIGLIAIA_IT)
         
         doc.add_paragraph()
         
@@ -344,35 +376,37 @@ def genera_report_combinato(
             # Tabella Top 5 agenzie
             ag_table = doc.add_table(rows=len(agenzie_stats) + 1, cols=3)
             ag_table.style = 'Light Grid Accent 1'
+            righe = _righe_tabella(ag_table)
             
             # Header
-            ag_table.rows[0].cells[0].text = 'Agenzia'
-            ag_table.rows[0].cells[1].text = 'N° Appartamenti'
-            ag_table.rows[0].cells[2].text = '% Mercato'
-            for cell in ag_table.rows[0].cells:
+            righe[0][0].text = 'Agenzia'
+            righe[0][1].text = 'N° Appartamenti'
+            righe[0][2].text = '% Mercato'
+            for cell in righe[0]:
                 cell.paragraphs[0].runs[0].font.bold = True
             
             # Dati
             for i, (_, row) in enumerate(agenzie_stats.iterrows(), 1):
                 percentuale = (row['count'] / n_app * 100)
-                ag_table.rows[i].cells[0].text = row['agenzia']
-                ag_table.rows[i].cells[1].text = str(int(row['count']))
-                ag_table.rows[i].cells[2].text = f"{percentuale:.1f}%"
+                righe[i][0].text = row['agenzia']
+                righe[i][1].text = str(int(row['count']))
+                righe[i][2].text = f"{percentuale:.1f}%"
             
             doc.add_paragraph()
             
-            # Concentrazione mercato
-            top3_count = agenzie_stats.head(3)['count'].sum()
-            top3_share = (top3_count / n_app * 100)
+            # Concentrazione mercato (già calcolata da calcola_statistiche;
+            # assente nelle statistiche costruite altrove)
+            top3_share = stats_immobiliare.get('top3_share')
             
-            doc.add_paragraph(f'Concentrazione Top 3: {top3_share:.1f}%', style='Heading 3')
+            if top3_share is not None:
+                doc.add_paragraph(f'Concentrazione Top 3: {top3_share:.1f}%', style='Heading 3')
             
-            if top3_share > 60:
-                doc.add_paragraph('⚠ Mercato concentrato - Pochi operatori dominanti')
-            elif top3_share > 40:
-                doc.add_paragraph('• Mercato moderato - Mix operatori grandi/piccoli')
-            else:
-                doc.add_paragraph('✓ Mercato frammentato - Molti piccoli operatori')
+                if top3_share > 60:
+                    doc.add_paragraph('⚠ Mercato concentrato - Pochi operatori dominanti')
+                elif top3_share > 40:
+                    doc.add_paragraph('• Mercato moderato - Mix operatori grandi/piccoli')
+                else:
+                    doc.add_paragraph('✓ Mercato frammentato - Molti piccoli operatori')
         
         doc.add_paragraph()
     
@@ -386,8 +420,8 @@ def genera_report_combinato(
         
         gap = ((mercato_med - omi_med) / omi_med) * 100
         
-        doc.add_paragraph(f"Valore OMI mediano: €{omi_med:,.0f}/m²".replace(',', '.'))
-        doc.add_paragraph(f"Prezzo mercato mediano: €{mercato_med:,.0f}/m²".replace(',', '.'))
+        doc.add_paragraph(f"Valore OMI mediano: €{omi_med:,.0f}/m²".translate(MIGLIAIA_IT))
+        doc.add_paragraph(f"Prezzo mercato mediano: €{mercato_med:,.0f}/m²".translate(MIGLIAIA_IT))
         doc.add_paragraph(f"Gap: {gap:+.1f}%".replace('.', ','))
         doc.add_paragraph()
         
@@ -428,6 +462,7 @@ def genera_report_combinato(
             
             gap_table = doc.add_table(rows=4, cols=2)
             gap_table.style = 'Light Grid Accent 1'
+            righe = _righe_tabella(gap_table)
             
             gap_data = [
                 ['OMI Mediano', f"€{gap['omi_mediano']:,.0f}/m²"],
@@ -437,9 +472,9 @@ def genera_report_combinato(
             ]
             
             for i, (label, value) in enumerate(gap_data):
-                gap_table.rows[i].cells[0].text = label
-                gap_table.rows[i].cells[0].paragraphs[0].runs[0].font.bold = True
-                gap_table.rows[i].cells[1].text = value
+                righe[i][0].text = label
+                righe[i][0].paragraphs[0].runs[0].font.bold = True
+                righe[i][1].text = value
             
             doc.add_paragraph()
         
@@ -488,8 +523,13 @@ def genera_report_combinato(
         doc.add_heading('🗺️ Mappa Appartamenti', 1)
         
         try:
-            # Crea mappa
-            mappa = crea_mappa_interattiva(
+            from map_generator import salva_mappa_html
+            
+            # Crea e salva mappa come HTML (da cache se gli input non sono cambiati)
+            mappa_filename = f"mappa_{comune_file}_{now.strftime('%Y%m%d_%H%M%S')}.html"
+            mappa_path = os.path.join(output_dir, mappa_filename)
+            salva_mappa_html(
+                mappa_path,
                 lat_centro=lat,
                 lon_centro=lon,
                 via=via,
@@ -499,12 +539,6 @@ def genera_report_combinato(
                 stats_immobiliare=stats_immobiliare
             )
             
-            # Salva mappa come HTML
-            import os
-            mappa_filename = f"mappa_{comune}_{now.strftime('%Y%m%d_%H%M%S')}.html"
-            mappa_path = os.path.join(output_dir, mappa_filename)
-            mappa.save(mappa_path)
-            
             doc.add_paragraph(f'La mappa interattiva è stata salvata in: {mappa_filename}')
             doc.add_paragraph('Apri il file HTML per visualizzare la mappa con tutti gli appartamenti.')
             doc.add_paragraph()
@@ -546,7 +580,7 @@ def genera_report_combinato(
     
     # Salva
     timestamp = now.strftime("%Y%m%d_%H%M%S")
-    filename = f"report_combinato_{comune}_{timestamp}.docx"
+    filename = f"report_combinato_{comune_file}_{timestamp}.docx"
     filepath = os.path.join(output_dir, filename)
     
     doc.save(filepath)
@@ -10,6 +10,9 @@ Integrazione:
 import streamlit as st
 import pandas as pd
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Import moduli locali
@@ -19,12 +22,15 @@ from immobiliare_scraper import cerca_appartamenti, calcola_statistiche
 from report_generator import genera_report_combinato
 # Import condizionale per evitare crash se claude_analyzer non esiste
 try:
-    from claude_analyzer import analizza_con_ai, get_api_key
-    CLAUDE_AVAILABLE = True
+    from claude_analyzer import ANTHROPIC_AVAILABLE, analizza_con_ai, get_api_key
+    # Il modulo si importa anche senza l'SDK anthropic (import ritardato)
+    CLAUDE_AVAILABLE = ANTHROPIC_AVAILABLE
+    if not CLAUDE_AVAILABLE:
+        print("⚠️ Libreria anthropic non installata - analisi AI disabilitata")
 except ImportError:
     CLAUDE_AVAILABLE = False
     print("⚠️ Modulo claude_analyzer non disponibile - analisi AI disabilitata")
-from config import REPORTS_DIR
+from config import MIGLIAIA_IT, REPORTS_DIR
 # Import opzionali per mappe e geocoding
 try:
     from map_generator import crea_mappa_interattiva, get_mappa_statistiche
@@ -40,13 +46,15 @@ st.set_page_config(
     layout="wide",
 )
 
-# Inizializza cache OMI
+# Inizializza cache OMI in background: KML + CSV si caricano mentre
+# l'utente compila il form (una sola volta per processo)
 @st.cache_resource
 def init_omi():
-    warmup_omi_cache()
-    return True
+    thread = threading.Thread(target=warmup_omi_cache, daemon=True)
+    thread.start()
+    return thread
 
-init_omi()
+warmup_omi_thread = init_omi()
 
 # ========================================
 # HEADER
@@ -136,10 +144,16 @@ else:
     
     st.stop()  # Blocca qui - non prosegue
 
+# Lo scraping (rete) dipende solo dalle coordinate: parte subito in background
+# mentre nel thread principale si cerca la zona OMI (calcolo locale)
+executor = ThreadPoolExecutor(max_workers=1)
+future_appartamenti = executor.submit(cerca_appartamenti, lat, lon, raggio_km, max_pagine=5)
+
 # 2. DATI OMI
 status_text.text("📊 Ricerca zona OMI...")
 progress_bar.progress(40)
 
+warmup_omi_thread.join()  # attende solo l'eventuale caricamento residuo
 zona_omi_obj = get_quotazione_omi_da_coordinate(lat, lon)
 
 # Converti oggetto OMI in dict per facilità
@@ -159,7 +173,8 @@ if zona_omi_obj:
 status_text.text("🏠 Scraping Immobiliare.it...")
 progress_bar.progress(60)
 
-appartamenti = cerca_appartamenti(lat, lon, raggio_km, max_pagine=5)
+appartamenti = future_appartamenti.result()
+executor.shutdown()
 
 # 4. CALCOLO STATISTICHE
 status_text.text("📈 Calcolo statistiche...")
@@ -174,16 +189,36 @@ status_text.text("✅ Analisi completata!")
 if abilita_ai and CLAUDE_AVAILABLE:
     status_text.text("🤖 Analisi AI in corso...")
     
+    # Anteprima dell'analisi mentre Claude la genera (streaming)
+    # Il testo viene ridisegnato al massimo ogni ANTEPRIMA_AI_INTERVALLO secondi:
+    # ridisegnarlo a ogni frammento reinvierebbe al browser tutto il markdown
+    # centinaia di volte
+    ANTEPRIMA_AI_INTERVALLO = 0.1
+    anteprima_ai = st.empty()
+    frammenti_ai = []
+    ultimo_aggiornamento_ai = [0.0]
+    
+    def mostra_frammento_ai(testo: str):
+        frammenti_ai.append(testo)
+        adesso = time.monotonic()
+        if adesso - ultimo_aggiornamento_ai[0] >= ANTEPRIMA_AI_INTERVALLO:
+            ultimo_aggiornamento_ai[0] = adesso
+            anteprima_ai.markdown("".join(frammenti_ai))
+    
     try:
         risultato_ai = analizza_con_ai(
             comune=comune,
             via=via,
             zona_omi=zona_omi,
-            stats_immobiliare=stats_immobiliare
+            stats_immobiliare=stats_immobiliare,
+            on_text=mostra_frammento_ai
         )
     except Exception as e:
         print(f"Errore analisi AI: {e}")
         risultato_ai = {'success': False, 'error': str(e)}
+    
+    # L'analisi completa viene mostrata nella sua sezione: rimuovi l'anteprima
+    anteprima_ai.empty()
 else:
     if not abilita_ai:
         print("ℹ️ Analisi AI disabilitata dall'utente")
@@ -212,13 +247,18 @@ try:
         output_dir=REPORTS_DIR
     )
     
-    # Leggi il file in memoria
-    with open(report_filepath, 'rb') as f:
-        report_data = f.read()
-    
-    report_filename = os.path.basename(report_filepath)
-    
-    status_text.text("✅ Report generato!")
+    if report_filepath:
+        # Leggi il file in memoria
+        with open(report_filepath, 'rb') as f:
+            report_data = f.read()
+        
+        report_filename = os.path.basename(report_filepath)
+        
+        status_text.text("✅ Report generato!")
+    else:
+        # Nessun dato da riportare
+        report_data = None
+        report_filename = None
     
 except Exception as e:
     print(f"Errore generazione report: {e}")
@@ -276,9 +316,9 @@ with tab1:
         with col2:
             st.subheader("Valori €/mq")
             col_min, col_med, col_max = st.columns(3)
-            col_min.metric("Minimo", f"€{zona_omi['val_min_mq']:,.0f}".replace(',', '.'))
-            col_med.metric("Mediano", f"€{zona_omi['val_med_mq']:,.0f}".replace(',', '.'))
-            col_max.metric("Massimo", f"€{zona_omi['val_max_mq']:,.0f}".replace(',', '.'))
+            col_min.metric("Minimo", f"€{zona_omi['val_min_mq']:,.0f}".translate(MIGLIAIA_IT))
+            col_med.metric("Mediano", f"€{zona_omi['val_med_mq']:,.0f}".translate(MIGLIAIA_IT))
+            col_max.metric("Massimo", f"€{zona_omi['val_max_mq']:,.0f}".translate(MIGLIAIA_IT))
         
         st.caption("Fonte: dati ufficiali rogiti - Agenzia delle Entrate (QI 2025/1)")
     else:
@@ -300,16 +340,16 @@ with tab2:
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("Prezzo Medio", f"€{stats_immobiliare['prezzo']['medio']:,.0f}".replace(',', '.'))
-            st.metric("Prezzo Mediano", f"€{stats_immobiliare['prezzo']['mediano']:,.0f}".replace(',', '.'))
+            st.metric("Prezzo Medio", f"€{stats_immobiliare['prezzo']['medio']:,.0f}".translate(MIGLIAIA_IT))
+            st.metric("Prezzo Mediano", f"€{stats_immobiliare['prezzo']['mediano']:,.0f}".translate(MIGLIAIA_IT))
         
         with col2:
             st.metric("Superficie Media", f"{stats_immobiliare['mq']['medio']:.0f} m²")
             st.metric("Superficie Mediana", f"{stats_immobiliare['mq']['mediano']:.0f} m²")
         
         with col3:
-            st.metric("Prezzo/mq Medio", f"€{stats_immobiliare['prezzo_mq']['medio']:,.0f}".replace(',', '.'))
-            st.metric("Prezzo/mq Mediano", f"€{stats_immobiliare['prezzo_mq']['mediano']:,.0f}".replace(',', '.'))
+            st.metric("Prezzo/mq Medio", f"€{stats_immobiliare['prezzo_mq']['medio']:,.0f}".translate(MIGLIAIA_IT))
+            st.metric("Prezzo/mq Mediano", f"€{stats_immobiliare['prezzo_mq']['mediano']:,.0f}".translate(MIGLIAIA_IT))
         
         st.markdown("---")
         
@@ -328,9 +368,9 @@ with tab2:
         
         # Formatta per display
         agenzie_display = agenzie.copy()
-        agenzie_display['Prezzo Medio'] = agenzie_display['Prezzo Medio'].apply(lambda x: f"€{x:,.0f}".replace(',', '.'))
+        agenzie_display['Prezzo Medio'] = agenzie_display['Prezzo Medio'].apply(lambda x: f"€{x:,.0f}".translate(MIGLIAIA_IT))
         agenzie_display['MQ Medio'] = agenzie_display['MQ Medio'].apply(lambda x: f"{x:.0f} m²")
-        agenzie_display['Prezzo/mq Medio'] = agenzie_display['Prezzo/mq Medio'].apply(lambda x: f"€{x:,.0f}/m²".replace(',', '.'))
+        agenzie_display['Prezzo/mq Medio'] = agenzie_display['Prezzo/mq Medio'].apply(lambda x: f"€{x:,.0f}/m²".translate(MIGLIAIA_IT))
         
         # Riordina colonne
         agenzie_display = agenzie_display[['Agenzia', 'N° Appartamenti', 'Prezzo Medio', 'MQ Medio', 'Prezzo/mq Medio']]
@@ -379,10 +419,10 @@ with tab3:
         
         col1, col2, col3 = st.columns(3)
         
-        col1.metric("OMI Mediano", f"€{omi_med:,.0f}/m²".replace(',', '.'))
-        col2.metric("Mercato Mediano", f"€{mercato_med:,.0f}/m²".replace(',', '.'))
+        col1.metric("OMI Mediano", f"€{omi_med:,.0f}/m²".translate(MIGLIAIA_IT))
+        col2.metric("Mercato Mediano", f"€{mercato_med:,.0f}/m²".translate(MIGLIAIA_IT))
         col3.metric("Gap", f"{gap:+.1f}%".replace('.', ','), 
-                   delta=f"€{mercato_med - omi_med:,.0f}/m²".replace(',', '.'))
+                   delta=f"€{mercato_med - omi_med:,.0f}/m²".translate(MIGLIAIA_IT))
         
         st.markdown("---")
         
@@ -609,14 +649,14 @@ with tab4:
         
         with col1:
             st.markdown("**📊 Valori OMI (Rogiti Reali)**")
-            st.metric("Valore Mediano OMI", f"€{omi_med:,.0f}/m²".replace(',', '.'))
+            st.metric("Valore Mediano OMI", f"€{omi_med:,.0f}/m²".translate(MIGLIAIA_IT))
             st.caption("Baseline ufficiale Agenzia Entrate")
         
         with col2:
             st.markdown("**🏠 Mercato Nuove Costruzioni**")
             st.metric("Range Prezzi", 
-                     f"€{mercato_min:,.0f} - €{mercato_max:,.0f}/m²".replace(',', '.'))
-            st.metric("Prezzo Mediano", f"€{mercato_med:,.0f}/m²".replace(',', '.'))
+                     f"€{mercato_min:,.0f} - €{mercato_max:,.0f}/m²".translate(MIGLIAIA_IT))
+            st.metric("Prezzo Mediano", f"€{mercato_med:,.0f}/m²".translate(MIGLIAIA_IT))
         
         st.markdown("---")
         
@@ -632,15 +672,15 @@ with tab4:
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("Entry Level", f"€{target_min:,.0f}/m²".replace(',', '.'))
+            st.metric("Entry Level", f"€{target_min:,.0f}/m²".translate(MIGLIAIA_IT))
             st.caption("Per vendita veloce")
         
         with col2:
-            st.metric("Sweet Spot", f"€{mercato_med:,.0f}/m²".replace(',', '.'))
+            st.metric("Sweet Spot", f"€{mercato_med:,.0f}/m²".translate(MIGLIAIA_IT))
             st.caption("Consigliato")
         
         with col3:
-            st.metric("Premium", f"€{target_max:,.0f}/m²".replace(',', '.'))
+            st.metric("Premium", f"€{target_max:,.0f}/m²".translate(MIGLIAIA_IT))
             st.caption("Se alta qualità")
         
         st.markdown("---")
@@ -653,16 +693,16 @@ with tab4:
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("OMI Baseline", f"€{omi_med:,.0f}/m²".replace(',', '.'))
+            st.metric("OMI Baseline", f"€{omi_med:,.0f}/m²".translate(MIGLIAIA_IT))
         
         with col2:
-            st.metric("Mercato Mediano", f"€{mercato_med:,.0f}/m²".replace(',', '.'))
+            st.metric("Mercato Mediano", f"€{mercato_med:,.0f}/m²".translate(MIGLIAIA_IT))
         
         with col3:
             gap_assoluto = mercato_med - omi_med
             st.metric("Gap", 
                      f"{gap_percentuale:+.1f}%".replace('.', ','),
-                     delta=f"€{gap_assoluto:,.0f}/m²".replace(',', '.'))
+                     delta=f"€{gap_assoluto:,.0f}/m²".translate(MIGLIAIA_IT))
         
         st.markdown("---")
         
@@ -755,25 +795,25 @@ with tab4:
                     hide_index=True
                 )
                 
-                # Analisi concentrazione
-                top3_count = agenzie_stats.head(3)['count'].sum()
-                top3_share = (top3_count / n_app * 100)
+                # Analisi concentrazione (già calcolata da calcola_statistiche)
+                top3_share = stats_immobiliare.get('top3_share')
                 
-                st.markdown("---")
-                st.markdown("**📊 Concentrazione Mercato:**")
+                if top3_share is not None:
+                    st.markdown("---")
+                    st.markdown("**📊 Concentrazione Mercato:**")
                 
-                col1, col2 = st.columns(2)
+                    col1, col2 = st.columns(2)
                 
-                with col1:
-                    st.metric("Top 3 Agenzie", f"{top3_share:.1f}%")
+                    with col1:
+                        st.metric("Top 3 Agenzie", f"{top3_share:.1f}%")
                 
-                with col2:
-                    if top3_share > 60:
-                        st.warning("Mercato concentrato - Pochi operatori dominanti")
-                    elif top3_share > 40:
-                        st.info("Mercato moderato - Mix operatori grandi/piccoli")
-                    else:
-                        st.success("Mercato frammentato - Molti piccoli operatori")
+                    with col2:
+                        if top3_share > 60:
+                            st.warning("Mercato concentrato - Pochi operatori dominanti")
+                        elif top3_share > 40:
+                            st.info("Mercato moderato - Mix operatori grandi/piccoli")
+                        else:
+                            st.success("Mercato frammentato - Molti piccoli operatori")
 
 
 # ----------------------------------------
@@ -792,6 +832,9 @@ with tab5:
         1. Crea il file `claude_analyzer.py` con le funzioni necessarie
         2. Carica il file nel repository GitHub
         3. Fai push e riavvia l'app Streamlit
+        
+        Se il file è presente, verifica che la libreria `anthropic` sia
+        installata (è in `requirements.txt`).
         """)
         st.stop()
     
@@ -828,10 +871,10 @@ with tab5:
                 gap = risultato['gap_analysis']
                 
                 col1, col2, col3 = st.columns(3)
-                col1.metric("OMI Mediano", f"€{gap['omi_mediano']:,.0f}/m²".replace(',', '.'))
-                col2.metric("Mercato Mediano", f"€{gap['mercato_mediano']:,.0f}/m²".replace(',', '.'))
+                col1.metric("OMI Mediano", f"€{gap['omi_mediano']:,.0f}/m²".translate(MIGLIAIA_IT))
+                col2.metric("Mercato Mediano", f"€{gap['mercato_mediano']:,.0f}/m²".translate(MIGLIAIA_IT))
                 col3.metric("Gap", f"{gap['gap_percentuale']:+.1f}%".replace('.', ','),
-                           delta=f"€{gap['gap_assoluto']:,.0f}/m²".replace(',', '.'))
+                           delta=f"€{gap['gap_assoluto']:,.0f}/m²".translate(MIGLIAIA_IT))
                 
                 st.markdown("---")
             
@@ -845,38 +888,39 @@ with tab5:
             st.subheader("💾 Salva Analisi")
             
             # Prepara testo completo
-            testo_completo = f"""ANALISI AI - Planet AI
+            parti_testo = [f"""ANALISI AI - Planet AI
 {'='*70}
 Località: {data['via']}, {data['comune']}
 Data: {datetime.now().strftime('%d/%m/%Y %H:%M')}
 {'='*70}
 
-"""
+"""]
             
             if risultato.get('gap_analysis'):
                 gap = risultato['gap_analysis']
-                testo_completo += f"""
+                parti_testo.append(f"""
 GAP ANALYSIS
 ------------
 OMI Mediano: €{gap['omi_mediano']:,.0f}/m²
 Mercato Mediano: €{gap['mercato_mediano']:,.0f}/m²
 Gap: {gap['gap_percentuale']:+.1f}% (€{gap['gap_assoluto']:,.0f}/m²)
 
-"""
+""")
             
-            testo_completo += f"""
+            parti_testo.append(f"""
 ANALISI DETTAGLIATA
 -------------------
 {risultato['analisi_completa']}
 
-"""
+""")
             
             if risultato.get('raccomandazioni'):
-                testo_completo += "\nRACCOMANDAZIONI\n---------------\n"
+                parti_testo.append("\nRACCOMANDAZIONI\n---------------\n")
                 for i, racc in enumerate(risultato['raccomandazioni'], 1):
-                    testo_completo += f"{i}. {racc}\n"
+                    parti_testo.append(f"{i}. {racc}\n")
             
-            testo_completo += f"\n{'='*70}\nGenerato da Planet AI - Powered by Claude (Anthropic)\n"
+            parti_testo.append(f"\n{'='*70}\nGenerato da Planet AI - Powered by Claude (Anthropic)\n")
+            testo_completo = "".join(parti_testo)
             
             st.download_button(
                 label="📥 Scarica Analisi AI (TXT)",
@@ -0,0 +1,127 @@
+"""
+Test della cache su disco (cache_utils): scadenza, pulizia delle voci
+scadute, limite di voci per gruppo e voci corrotte.
+
+Ogni test usa un database SQLite in una cartella temporanea.
+"""
+
+import time
+
+import pytest
+
+import cache_utils
+
+
+class Orologio:
+    """Orologio finto: sostituisce time.time() durante il test."""
+
+    def __init__(self, adesso: float = 1_000_000.0):
+        self.adesso = adesso
+
+    def __call__(self) -> float:
+        return self.adesso
+
+
+@pytest.fixture
+def orologio(monkeypatch):
+    finto = Orologio()
+    monkeypatch.setattr(time, "time", finto)
+    return finto
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """cache_utils su un database nuovo in tmp_path, con durate e limiti di test."""
+    monkeypatch.setattr(cache_utils, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(cache_utils, "_DB_PATH", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(cache_utils, "_conn", None)
+    monkeypatch.setattr(cache_utils, "_scritture", 0)
+    monkeypatch.setattr(cache_utils, "CACHE_TTL_NAMESPACE", {"breve": 10, "lungo": 100})
+    monkeypatch.setattr(cache_utils, "CACHE_MAX_VOCI", {"pagine": 3})
+
+    yield cache_utils
+
+    if cache_utils._conn is not None:
+        cache_utils._conn.close()
+
+
+def _chiavi(cache, namespace):
+    righe = cache._get_conn().execute(
+        "SELECT key FROM cache WHERE namespace = ? ORDER BY key", (namespace,)
+    ).fetchall()
+    return [r[0] for r in righe]
+
+
+def test_valore_riletto(cache, orologio):
+    cache.cache_set("breve", "k", {"a": [1, 2]})
+
+    assert cache.cache_get("breve", "k", ttl=10) == {"a": [1, 2]}
+    assert cache.cache_get("breve", "assente", ttl=10) is None
+
+
+def test_voce_scaduta_non_restituita(cache, orologio):
+    cache.cache_set("breve", "k", 1)
+
+    orologio.adesso += 11
+    assert cache.cache_get("breve", "k", ttl=10) is None
+
+
+def test_pulizia_cancella_voci_scadute(cache, orologio):
+    cache.cache_set("breve", "vecchia", 1)
+    cache.cache_set("lungo", "vecchia", 1)
+    orologio.adesso += 50
+    cache.cache_set("breve", "nuova", 2)
+
+    with cache._lock:
+        cache._pulisci_scaduti(cache._get_conn())
+
+    # "breve" dura 10 s: la voce di 50 s fa è cancellata; "lungo" (100 s) resta
+    assert _chiavi(cache, "breve") == ["nuova"]
+    assert _chiavi(cache, "lungo") == ["vecchia"]
+
+
+def test_gruppo_senza_durata_usa_la_piu_lunga(cache, orologio):
+    cache.cache_set("altro", "k", 1)
+
+    orologio.adesso += 50
+    with cache._lock:
+        cache._pulisci_scaduti(cache._get_conn())
+    assert _chiavi(cache, "altro") == ["k"]
+
+    orologio.adesso += 51
+    with cache._lock:
+        cache._pulisci_scaduti(cache._get_conn())
+    assert _chiavi(cache, "altro") == []
+
+
+def test_pulizia_periodica_durante_le_scritture(cache, orologio, monkeypatch):
+    monkeypatch.setattr(cache, "_SCRITTURE_TRA_PULIZIE", 2)
+    cache.cache_set("breve", "vecchia", 1)
+    orologio.adesso += 11
+
+    cache.cache_set("lungo", "a", 1)  # seconda scrittura: pulizia
+
+    assert _chiavi(cache, "breve") == []
+
+
+def test_limite_voci_per_gruppo(cache, orologio):
+    for i in range(5):
+        orologio.adesso += 1
+        cache.cache_set("pagine", f"p{i}", i)
+        cache.cache_set("lungo", f"p{i}", i)
+
+    # Restano le 3 più recenti; gli altri gruppi non hanno limite
+    assert _chiavi(cache, "pagine") == ["p2", "p3", "p4"]
+    assert len(_chiavi(cache, "lungo")) == 5
+
+
+def test_voce_corrotta_come_assente(cache, orologio, capsys):
+    conn = cache._get_conn()
+    conn.execute(
+        "INSERT INTO cache (namespace, key, value, ts) VALUES (?, ?, ?, ?)",
+        ("breve", "rotta", b"{non json", orologio.adesso),
+    )
+    conn.commit()
+
+    assert cache.cache_get("breve", "rotta", ttl=10) is None
+    assert "[CACHE][WARN]" in capsys.readouterr().out